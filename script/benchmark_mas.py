@@ -0,0 +1,85 @@
+from helper import *
+from fourier import *
+from compute_powerspec import iterate_particles, species2ptype, threads
+import gadget
+import time
+
+# Specifications
+mass = 0.15         # neutrino mass in eV of the snapshot
+sim = 'HR'          # simulation type, whose grid size is used for the current and reference spectra
+code = 'gadget3'    # simulation code
+z = 0               # redshift
+species = 'cdm'     # species of the auto power spectra
+gridsize = 512      # grid size of the tested mass assignments
+current = ('CIC', False)    # mass assignment (and interlacing) of compute_powerspec.py
+reference = ('PCS', True)   # most accurate mass assignment, used for the reference spectrum
+schemes = [                 # tested mass assignments
+    ('CIC', False),
+    ('CIC', True),
+    ('TSC', False),
+    ('TSC', True),
+    ('PCS', False),
+    ('PCS', True),
+]
+k_fractions = [0.25, 0.5, 0.75, 1]  # upper limits of k in units of the Nyquist frequency of gridsize
+
+# Main function
+def benchmark(mass, sim, code, z, species, gridsize, current, reference, schemes, k_fractions):
+    # Deviations of the spectra of each mass assignment scheme on a grid
+    # of size gridsize, and of the current spectrum, from a reference
+    # computed with the most accurate scheme on the grid of the simulation
+    boxsize, gridsize_sim = get_boxgrid(sim)
+    filename_snapshot = get_filename(mass, sim, code, z, 'snapshot/snapshot')
+    header = gadget.header(filename_snapshot)
+    ptype = species2ptype[species]
+    def get_powerspec(gridsize, mas, interlaced):
+        t0 = time.perf_counter()
+        deltas = []
+        for shift in ([0, 0.5] if interlaced else [0]):
+            shift = np.float32(shift*boxsize/gridsize)
+            delta = new_grid(gridsize)
+            for pos, weights in iterate_particles(
+                filename_snapshot, ptype, header.massarr[ptype] == 0,
+            ):
+                MAS_library.MA(pos + shift, delta, boxsize, mas, W=weights, verbose=False)
+            delta /= np.mean(delta, dtype=np.float64)
+            delta -= 1
+            deltas.append(delta)
+        delta_k = fft_field(deltas[0], mas, threads, *deltas[1:])
+        del deltas
+        k, power, _ = get_power(delta_k, boxsize)
+        # Grids transformed in place
+        memory = (1 + interlaced)*8*gridsize**2*(gridsize//2 + 1)/2**30
+        return k, power, time.perf_counter() - t0, memory
+    def get_name(gridsize, mas, interlaced):
+        return f'{gridsize}³ {mas}' + ' interlaced'*interlaced
+    # Compare shells within the Nyquist frequency of the smaller grid
+    _, power_reference, *_ = get_powerspec(gridsize_sim, *reference)
+    n = min(gridsize, gridsize_sim)//2 - 1
+    k_nyquist = np.pi*gridsize/boxsize
+    print(
+        f'{get_sim_name(mass, sim)} {code} z={z} {species}, '
+        f'deviations from {get_name(gridsize_sim, *reference)}'
+    )
+    print(
+        f'{"mass assignment": <24} {"time": >8} {"memory": >9}  '
+        + ' '.join(f'{f"k < {k_fraction:g} k_Nyq": >14}' for k_fraction in k_fractions)
+    )
+    for gridsize_scheme, (mas, interlaced) in (
+        [(gridsize_sim, current)] + [(gridsize, scheme) for scheme in schemes]
+    ):
+        k, power, time_scheme, memory = get_powerspec(gridsize_scheme, mas, interlaced)
+        deviation = np.abs(power[:n]/power_reference[:n] - 1)
+        name = get_name(gridsize_scheme, mas, interlaced)
+        if gridsize_scheme == gridsize_sim and (mas, interlaced) == current:
+            name += ' (current)'
+        print(
+            f'{name: <24} {time_scheme:6.1f} s {memory:6.2f} GB  '
+            + ' '.join(
+                f'{np.max(deviation[k[:n] < k_fraction*k_nyquist], initial=0):14.2e}'
+                for k_fraction in k_fractions
+            )
+        )
+
+if __name__ == '__main__':
+    benchmark(mass, sim, code, z, species, gridsize, current, reference, schemes, k_fractions)
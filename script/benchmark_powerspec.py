@@ -0,0 +1,90 @@
+from helper import *
+from fourier import *
+from compute_powerspec import spectra, mas, axis, threads
+import time
+
+# Specifications
+gridsize = 256   # grid size of the (random) benchmark fields
+boxsize = 512    # box size in Mpc/h
+weights = {      # mass fractions used for combined fields
+    'cdm': 0.99,
+    'ncdm': 0.01,
+}
+k_desired = np.logspace(np.log10(1e-2), np.log10(1e+1), 50)  # bin edges of log-binned spectra
+
+# Main function
+def benchmark(gridsize, boxsize, spectra, weights, k_desired):
+    # Time the spectra through Pylians (one FFT per field per spectrum)
+    # against fourier.py (one in-place FFT per field), on random fields
+    rng = np.random.default_rng(0)
+    fields = {}
+    def get_delta(species):
+        if species not in fields:
+            fields[species] = new_grid(gridsize)
+            fields[species][...] = rng.standard_normal([gridsize]*3, dtype=np.float32)
+        return fields[species]
+    def parse(spectrum):
+        spectrum_type = ('cross' if 'x' in spectrum else 'auto')
+        species = spectrum.replace(' ', '').split({'auto': '+', 'cross': 'x'}[spectrum_type])
+        return spectrum_type, species
+    # Prepare real space fields, including combined fields
+    for spectrum in spectra:
+        spectrum_type, species = parse(spectrum)
+        for s in species:
+            get_delta(s)
+        if len(species) > 1 and spectrum_type == 'auto':
+            fields[spectrum] = np.ascontiguousarray(
+                sum(np.float32(weights[s])*get_delta(s) for s in species)
+            )
+    # Pylians
+    results = {}
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # silence Pylians
+        for spectrum in spectra:
+            spectrum_type, species = parse(spectrum)
+            if spectrum_type == 'auto':
+                delta = get_delta(spectrum if len(species) > 1 else species[0])
+                pk = Pk_library.Pk(delta, boxsize, axis, mas, threads, verbose=False)
+                results[spectrum] = pk.Pk[:, 0]
+            else:
+                pk = Pk_library.XPk([get_delta(s) for s in species], boxsize, axis, [mas]*2, threads)
+                results[spectrum] = pk.XPk[:, 0, 0]
+    time_pylians = time.perf_counter() - t0
+    # Fourier space fields, transforming the real space fields in place
+    t0 = time.perf_counter()
+    fields_k = {}
+    deltas_k = {}
+    for spectrum in spectra:
+        spectrum_type, species = parse(spectrum)
+        for s in species:
+            if s not in fields_k:
+                fields_k[s] = fft_field(fields.pop(s), mas, threads)
+        if spectrum_type == 'auto':
+            deltas_k[spectrum] = [fields_k[species[0]]]
+            if len(species) > 1:
+                deltas_k[spectrum] = [sum(np.float32(weights[s])*fields_k[s] for s in species)]
+        else:
+            deltas_k[spectrum] = [fields_k[s] for s in species]
+        _, power, _ = get_power(deltas_k[spectrum][0], boxsize, *deltas_k[spectrum][1:])
+        results[spectrum] = (results[spectrum], power)
+    time_fourier = time.perf_counter() - t0
+    # Direct log-binning
+    t0 = time.perf_counter()
+    for spectrum in spectra:
+        k, _, _ = get_power(
+            deltas_k[spectrum][0], boxsize, *deltas_k[spectrum][1:], k_desired=k_desired,
+        )
+    time_log = time.perf_counter() - t0
+    # Report
+    print(f'{gridsize}³ grid, {len(spectra)} spectra, {threads} thread(s)')
+    print(f'{"spectrum": <24} max difference relative to max |P|')
+    for spectrum, (power_pylians, power) in results.items():
+        difference = np.max(np.abs(power - power_pylians))/np.max(np.abs(power_pylians))
+        print(f'{spectrum: <24} {difference:.2e}')
+    print(f'Pylians:       {time_pylians:8.2f} s')
+    print(f'Fourier cache: {time_fourier:8.2f} s ({len(fields_k)} FFTs)')
+    print(f'Speedup:       {time_pylians/time_fourier:8.2f}x')
+    print(f'Log-binned:    {time_log:8.2f} s ({k.size} non-empty bins)')
+
+if __name__ == '__main__':
+    benchmark(gridsize, boxsize, spectra, weights, k_desired)
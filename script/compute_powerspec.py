@@ -1,7 +1,10 @@
 from helper import *
+from fourier import *
+import gadget, slabs
+import datetime, multiprocessing, resource, shutil, socket, time
 
 # Specifications
-recompute = False                            # recompute existing results?
+recompute = False                            # recompute existing results, even if up to date?
 masses = [0, 0.15, 0.3, 0.6]                 # neutrino mass in eV;  from [0, 0.15, 0.3, 0.6]
 simulations = ['fiducial', 'HR', '1024Mpc']  # simulation type;      from ['fiducial', 'HR', '1024Mpc']
 codes = ['gadget3']                          # simulation code;      from ['gadget3']
@@ -16,11 +19,28 @@ spectra = [                                  # species for spectra;  from ['cdm'
 ]
 
 # Global constants
-mas = 'CIC'
-axis = 0
+mas = os.environ.get('NUCODECOMP_MAS', 'CIC')  # mass assignment scheme; from ['NGP', 'CIC', 'TSC', 'PCS']
+interlaced = bool(int(os.environ.get('NUCODECOMP_INTERLACE', 0)))  # interlace density fields?
+axis = 0  # line of sight
+rsd = bool(int(os.environ.get('NUCODECOMP_RSD', 0)))  # redshift-space positions along axis, with multipoles?
 verbose = False
 halo_density_criterion = '200b'
 threads = int(os.environ.get('OMP_NUM_THREADS', 1))
+processes = int(os.environ.get('NUCODECOMP_PROCESSES', 1))  # snapshots processed concurrently
+memory_budget = float(os.environ.get('NUCODECOMP_MEMORY', 30))  # RAM budget in GB
+chunksize = 2**22  # number of particles read and deposited at a time
+outofcore = float(os.environ.get('NUCODECOMP_OUTOFCORE', 0))  # RAM in GB for out-of-core grids (0 to keep grids in memory)
+scratch_dir = os.environ.get('NUCODECOMP_SCRATCH', f'{cache_dir}/scratch')  # directory of out-of-core grids
+folds = int(os.environ.get('NUCODECOMP_FOLDS', 0))  # number of times to fold the box (by factors 2, 4, 8, ...)
+fold_stitch = float(os.environ.get('NUCODECOMP_FOLD_STITCH', 0.5))  # stitch points in units of the Nyquist frequency
+binary = bool(int(os.environ.get('NUCODECOMP_BINARY', 0)))  # also save spectra in binary (.npz) form?
+checkpoint = bool(int(os.environ.get('NUCODECOMP_CHECKPOINT', 0)))  # checkpoint density fields within the scratch directory?
+filename_ledger = f'{data_dir}/powerspec_ledger.jsonl'  # record of the states of all tasks
+profile = bool(int(os.environ.get('NUCODECOMP_PROFILE', 0)))  # record resource usage of each stage?
+filename_profile = f'{data_dir}/powerspec_profile.jsonl'  # record of the resource usage
+version = 1  # version of the computation, to be incremented upon changes affecting the spectra
+species2ptype = {'cdm': 1, 'ncdm': 2}
+ptype2species = {ptype: species for species, ptype in species2ptype.items()}
 
 # Main function
 def compute(masses, simulations, codes, redshifts, spectra, recompute=False):
@@ -30,89 +50,651 @@ def compute(masses, simulations, codes, redshifts, spectra, recompute=False):
     redshifts   = any2list(redshifts)
     spectra     = any2list(spectra)
     # Helper functions
-    def get_delta(filename_or_pos, ptypes=None):
-        if ptypes is None:
-            # Construct delta from positions
-            delta = np.zeros([gridsize]*3, dtype=np.float32)
-            MAS_library.MA(filename_or_pos, delta, boxsize, mas, verbose=verbose)
-        else:
-            # Construct delta from snapshot
-            delta = MAS_library.density_field_gadget(
-                filename_or_pos, ptypes, gridsize, mas, axis=axis, verbose=verbose,
-            )
-        delta /= np.mean(delta, dtype=np.float64)
-        delta -= 1
-        return delta
     @functools.lru_cache
     def get_nhalo(mass, sim, code, z, threshold):
-        halomasses, _ = load_halo(mass, sim, code, z, 'cdm', threshold=threshold)
-        return len(halomasses)
-    # Carry out computations
-    species2ptype = {'cdm': 1, 'ncdm': 2}
-    for mass, sim, code, z, spectrum in itertools.product(
-        masses, simulations, codes, redshifts, spectra,
+        return count_halos(mass, sim, code, z, 'cdm', threshold)
+    # Plan the computations as one task per snapshot, listing the spectra
+    # to compute as jobs together with the density fields they need
+    offset_profile = (os.path.getsize(filename_profile) if os.path.isfile(filename_profile) else 0)
+    usage = get_usage()
+    tasks = []
+    for mass, sim, code, z in itertools.product(
+        masses, simulations, codes, redshifts,
     ):
-        # Define needed information
-        boxsize, gridsize = get_boxgrid(sim)
-        filename_output = get_filename(mass, sim, code, z, f'powerspec_{spectrum}')
-        if not recompute and os.path.isfile(filename_output):
-            continue
         filename_snapshot = get_filename(mass, sim, code, z, 'snapshot/snapshot')
         if not glob(f'{filename_snapshot}*'):
             continue
-        if 'halo' in spectrum:
-            filename_halo = get_filename(mass, sim, code, z, 'halo_cdm')
-            if not os.path.isfile(filename_halo):
+        header = gadget.header(filename_snapshot)
+        filenames_snapshot = gadget.open_snapshot(filename_snapshot).filenames
+        jobs = []
+        for spectrum in spectra:
+            # Redshift-space multipoles are kept apart from the
+            # real-space power spectra read by the figure scripts
+            basename = f'{"multipoles" if rsd else "powerspec"}_{spectrum}'
+            filename_output = get_filename(mass, sim, code, z, basename)
+            filenames_halo = []
+            if 'halo' in spectrum:
+                if rsd:
+                    # The halo catalogs carry no velocities
+                    continue
+                filename_halo = get_filename(mass, sim, code, z, 'halo_cdm')
+                if not os.path.isfile(filename_halo):
+                    continue
+                filenames_halo.append(filename_halo)
+            spectrum_type = ('cross' if 'x' in spectrum else 'auto')
+            ptypes = [
+                species2ptype[species]
+                for species in (
+                    spectrum
+                    .replace(' ', '')
+                    .split({'auto': '+', 'cross': 'x'}[spectrum_type])
+                )
+                if not species.startswith('halo')
+            ]
+            if not all(header.nall[ptype] > 0 for ptype in ptypes):
                 continue
-        spectrum_type = ('cross' if 'x' in spectrum else 'auto')
-        ptypes = [
-            species2ptype[species]
-            for species in (
-                spectrum
-                .replace(' ', '')
-                .split({'auto': '+', 'cross': 'x'}[spectrum_type])
+            if spectrum_type == 'auto':
+                keys = [ptypes[0] if len(ptypes) == 1 else tuple(ptypes)]
+            else:
+                keys = ptypes.copy()
+                if len(keys) == 1:
+                    # Halos
+                    threshold, ref = re.search(r'halo(.*)ref(.*)', spectrum).groups()
+                    nhalo = get_nhalo(float(ref) if ref else mass, sim, code, z, threshold)
+                    keys.append(('halo', nhalo))
+                    if ref:
+                        # The number of halos is set by the reference catalog
+                        filenames_halo.append(
+                            get_filename(float(ref), sim, code, z, 'halo_cdm')
+                        )
+            # Compute only stale outputs, unless recomputing everything
+            data_name = f'{get_sim_name(mass, sim)} {code} z={z} {spectrum}'
+            fingerprint = get_fingerprint(sim, filenames_snapshot, filenames_halo)
+            if recompute:
+                reasons = ['recompute requested']
+            elif not os.path.isfile(filename_output):
+                reasons = ['no output']
+            else:
+                fingerprint_output = read_fingerprint(filename_output)
+                if fingerprint_output is None:
+                    # E.g. downloaded outputs
+                    print(f'Skipping {data_name}: no fingerprint recorded')
+                    continue
+                reasons = get_changes(fingerprint_output, fingerprint)
+                if not reasons:
+                    print(f'Skipping {data_name}: up to date')
+                    continue
+            print(f'Scheduling {data_name}: {", ".join(reasons)}')
+            jobs.append(Job(spectrum, spectrum_type, keys, filename_output, fingerprint))
+        if jobs:
+            tasks.append(
+                Task(mass, sim, code, z, jobs, estimate_memory(sim, header, jobs))
             )
-            if not species.startswith('halo')
-        ]
-        header = readgadget.header(filename_snapshot)
-        if not all(header.nall[ptype] > 0 for ptype in ptypes):
+    # Report tasks left unfinished by previous runs, which resume from
+    # their saved spectra (and checkpointed density fields)
+    states = read_ledger()
+    for task in tasks:
+        state = states.get(get_task_name(task))
+        if state in {'started', 'saved', 'failed'}:
+            print(
+                f'Resuming {get_task_name(task)}, '
+                f'{"failed" if state == "failed" else "interrupted"} during a previous run'
+            )
+        record(task, 'scheduled', spectra=[job.spectrum for job in task.jobs])
+    if profile:
+        write_profile(None, 'plan', add_usage({'threads': 1}, usage))
+    # Carry out computations
+    schedule(tasks)
+    if profile:
+        print_profile(offset_profile)
+
+# Fingerprints of outputs
+def get_fingerprint(sim, filenames_snapshot, filenames_halo):
+    # Inputs and settings of a power spectrum, with the data files
+    # represented by their sizes and modification times
+    boxsize, gridsize = get_boxgrid(sim)
+    def get_files_hash(filenames):
+        if not filenames:
+            return None
+        stats = [os.stat(filename) for filename in filenames]
+        return get_hash([
+            (os.path.basename(filename), stat.st_size, stat.st_mtime_ns)
+            for filename, stat in zip(filenames, stats)
+        ])
+    return {
+        'snapshot': get_files_hash(filenames_snapshot),
+        'halos': get_files_hash(filenames_halo),
+        'boxsize': boxsize,
+        'gridsize': gridsize,
+        'mas': mas,
+        'interlace': interlaced,
+        'axis': axis,
+        'rsd': rsd,
+        'folds': folds,
+        'fold_stitch': (fold_stitch if folds else None),
+        'version': version,
+    }
+def read_fingerprint(filename):
+    # Fingerprint recorded within the header of an output
+    for line in read_header(filename):
+        if line.startswith('Fingerprint: '):
+            with contextlib.suppress(ValueError):
+                return json.loads(line.partition(': ')[2])
+    return None
+def get_changes(fingerprint_old, fingerprint):
+    # Descriptions of the differences between two fingerprints
+    changes = []
+    for name, value in fingerprint.items():
+        value_old = fingerprint_old.get(name)
+        if value_old == value:
             continue
-        sim_name = get_sim_name(mass, sim)
-        data_name = f'{sim_name} {code} z={z} {spectrum}'
-        # Compute density field and power spectrum
-        if spectrum_type == 'auto':
-            print(f'Computing density field for {data_name}')
-            delta = get_delta(filename_snapshot, ptypes)
-            print(f'Computing auto power spectrum for {data_name}')
-            pk = Pk_library.Pk(delta, boxsize, axis, mas, threads, verbose)
-            power = pk.Pk[:, 0]
-        elif spectrum_type == 'cross':
-            print(f'Computing density fields for {data_name}')
-            deltas = [get_delta(filename_snapshot, [ptype]) for ptype in ptypes]
-            if len(deltas) == 1:
-                # Halos
-                threshold, ref = re.search(r'halo(.*)ref(.*)', spectrum).groups()
-                nhalo = get_nhalo(float(ref) if ref else mass, sim, code, z, threshold)
-                _, pos = load_halo(mass, sim, code, z, 'cdm', threshold=nhalo)
-                deltas.append(get_delta(pos))
-            print(f'Computing cross power spectrum for {data_name}')
-            pk = Pk_library.XPk(deltas, boxsize, axis, [mas]*2, threads)
-            power = pk.XPk[:, 0, 0]
-        k = pk.k3D
-        modes = pk.Nmodes3D
+        if name in {'snapshot', 'halos'}:
+            changes.append(f'{name} changed')
+        else:
+            changes.append(f'{name} changed from {value_old} to {value}')
+    return changes
+
+# Job ledger, with each change of state of a task appended as a line
+def record(task, state, **info):
+    entry = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'task': get_task_name(task),
+        'state': state,
+        'pid': os.getpid(),
+        **info,
+    }
+    append_line(filename_ledger, entry)
+def append_line(filename, entry):
+    # A single write in append mode, so that the lines of concurrent
+    # processes do not interleave
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(fd, f'{json.dumps(entry)}\n'.encode())
+    finally:
+        os.close(fd)
+def read_ledger():
+    # Latest state of each task
+    states = {}
+    with contextlib.suppress(FileNotFoundError):
+        with open(filename_ledger, 'r') as f:
+            for line in f:
+                # Skip any line cut short by a crash
+                with contextlib.suppress(ValueError, KeyError):
+                    entry = json.loads(line)
+                    states[entry['task']] = entry['state']
+    return states
+def get_task_name(task):
+    return f'{get_sim_name(task.mass, task.sim)} {task.code} z={task.z}'
+
+# Instrumentation, recording the resource usage of each stage of a task
+# (summed over its occurrences) as a line of the profile
+def get_usage():
+    # Wall and CPU time in s and bytes read from storage by this process
+    usage = {'wall': time.perf_counter(), 'cpu': time.process_time(), 'bytes_read': 0}
+    with contextlib.suppress(OSError):
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'read_bytes':
+                    usage['bytes_read'] = int(value)
+    return usage
+def add_usage(totals, usage_start):
+    # Add the usage since usage_start to the totals of a stage, along
+    # with the peak memory of the process so far. The latter includes
+    # all earlier stages and tasks of the process, not just this stage.
+    usage = get_usage()
+    for name, value in usage.items():
+        totals[name] = totals.get(name, 0) + value - usage_start[name]
+    totals['peak_memory_process'] = get_peak_memory()
+    return totals
+def get_peak_memory():
+    # Peak resident set size of this process in GB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*2**10/2**30
+def write_profile(task_name, stage, totals):
+    append_line(filename_profile, {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        'cpus': os.cpu_count(),
+        'task': task_name,
+        'stage': stage,
+        **totals,
+    })
+def print_profile(offset):
+    # Summary table of the stages over all tasks profiled since offset
+    # (in bytes) within the profile
+    summary = {}
+    with open(filename_profile, 'r') as f:
+        f.seek(offset)
+        for line in f:
+            entry = json.loads(line)
+            totals = summary.setdefault(entry['stage'], collections.Counter())
+            for name in ('wall', 'cpu', 'bytes_read'):
+                totals[name] += entry[name]
+            for name in ('threads', 'peak_memory_process'):
+                totals[name] = max(totals[name], entry[name])
+    print(
+        f'{"stage": <12} {"threads": >8} {"wall [s]": >10} {"CPU [s]": >10} '
+        f'{"read [GB]": >10} {"process peak so far [GB]": >25}'
+    )
+    for stage, totals in summary.items():
+        print(
+            f'{stage: <12} {totals["threads"]:8d} {totals["wall"]:10.2f} {totals["cpu"]:10.2f} '
+            f'{totals["bytes_read"]/2**30:10.2f} {totals["peak_memory_process"]:25.2f}'
+        )
+
+# Scheduling of tasks
+Job = collections.namedtuple(
+    'Job', ('spectrum', 'spectrum_type', 'keys', 'filename_output', 'fingerprint'),
+)
+Task = collections.namedtuple(
+    'Task', ('mass', 'sim', 'code', 'z', 'jobs', 'memory'),
+)
+def estimate_memory(sim, header, jobs):
+    # Peak memory of a task in GB, counting every density field held in
+    # Fourier space at once, with real space grids transformed in place
+    # (and an extra field when interlacing), and a chunk of particle
+    # positions and masses (and velocities), with the fields multiplied
+    # by the number of fold factors. With out-of-core grids, the fields
+    # are replaced by the memory allotted to the slabs.
+    _, gridsize = get_boxgrid(sim)
+    memory_particles = (16 + 12*rsd)*min(chunksize, max(header.nall))
+    if outofcore:
+        return outofcore + memory_particles/2**30
+    keys = set()
+    for job in jobs:
+        for key in job.keys:
+            keys.add(key)
+            if isinstance(key, tuple) and key[0] != 'halo':
+                keys.update(key)
+    memory_field = 8*gridsize**2*(gridsize//2 + 1)
+    return (
+        (folds + 1)*(len(keys) + interlaced)*memory_field + memory_particles
+    )/2**30
+def schedule(tasks):
+    # Tasks run concurrently in a pool of processes, with a task only
+    # admitted while the summed memory estimate of the running tasks
+    # stays within the budget. The threads are divided evenly between
+    # the processes.
+    if processes == 1 or len(tasks) < 2:
+        for task in tasks:
+            run_task(task, threads)
+        return
+    threads_task = max(1, threads//processes)
+    for task in tasks:
+        if task.memory > memory_budget:
+            print(
+                f'Estimated memory of {task.memory:.1f} GB for '
+                f'{get_sim_name(task.mass, task.sim)} {task.code} z={task.z} '
+                f'exceeds the budget of {memory_budget:g} GB',
+                file=sys.stderr,
+            )
+    # The number of threads is passed explicitly to the transforms.
+    # The worker processes are further spawned rather than forked,
+    # so that the OpenMP (and BLAS) runtimes are initialised anew
+    # within each, reading the reduced number of threads set here.
+    environ = os.environ.copy()
+    os.environ['OMP_NUM_THREADS'] = str(threads_task)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('spawn'),
+        ) as executor:
+            pending = list(tasks)
+            running = {}
+            while pending or running:
+                for task in pending.copy():
+                    if len(running) == processes:
+                        break
+                    memory = sum(task_running.memory for task_running in running.values())
+                    if running and memory + task.memory > memory_budget:
+                        continue
+                    running[executor.submit(run_task, task, threads_task)] = task
+                    pending.remove(task)
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    running.pop(future)
+                    future.result()
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+# Computation of all power spectra of a single snapshot
+def run_task(task, threads):
+    # Carry out a task, with its progress recorded in the ledger
+    record(task, 'started')
+    try:
+        compute_task(task, threads)
+    except BaseException as e:
+        record(task, 'failed', error=repr(e))
+        raise
+    record(task, 'finished')
+def compute_task(task, threads):
+    mass, sim, code, z, jobs, _ = task
+    boxsize, gridsize = get_boxgrid(sim)
+    filename_snapshot = get_filename(mass, sim, code, z, 'snapshot/snapshot')
+    header = gadget.header(filename_snapshot)
+    sim_name = get_sim_name(mass, sim)
+    group_name = f'{sim_name} {code} z={z}'
+    rows = slabs.get_rows(gridsize, outofcore)
+    factors = [2**i for i in range(folds + 1)]
+    shifts = ([0, 0.5] if interlaced else [0])
+    stages = {}
+    # Helper functions
+    @contextlib.contextmanager
+    def measure(stage, threads=1):
+        # Resource usage of a stage, leaving the computation untouched.
+        # Only the transforms run on multiple threads.
+        if not profile:
+            yield
+            return
+        usage = get_usage()
+        try:
+            yield
+        finally:
+            add_usage(stages.setdefault(stage, {'threads': threads}), usage)
+    def get_deltas(filename_or_pos, ptypes=None):
+        # Density contrasts for each fold factor, and for each shift of
+        # the particles by a fraction of a grid cell along each axis,
+        # all deposited within a single pass over the particles
+        grids = {}
+        for factor, shift in itertools.product(factors, shifts):
+            if outofcore:
+                grids[factor, shift] = slabs.Deposition(
+                    gridsize, boxsize/factor, mas, rows, scratch_dir,
+                )
+            else:
+                grids[factor, shift] = new_grid(gridsize)
+        if ptypes is None:
+            # Construct delta from positions
+            pos = np.require(filename_or_pos, np.float32, ['C', 'W'])
+            chunks = [(pos, None)]
+        else:
+            # Construct delta from snapshot, streaming the particles in
+            # chunks. With several particle types or masses not in the
+            # header, the particles are weighted by their masses, as in
+            # MAS_library.density_field_gadget().
+            chunks = (
+                chunk
+                for ptype in ptypes
+                for chunk in iterate_particles(
+                    filename_or_pos, ptype,
+                    len(ptypes) > 1 or header.massarr[ptype] == 0, rsd,
+                )
+            )
+        chunks = iter(chunks)
+        while True:
+            with measure('read'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            pos, weights = chunk
+            with measure('deposit'):
+                for (factor, shift), grid in grids.items():
+                    # Fold the particles into a box of size boxsize/factor
+                    # and shift them, relying on the periodic wrapping of
+                    # the deposition.
+                    boxsize_fold = boxsize/factor
+                    pos_fold = pos
+                    if factor > 1:
+                        pos_fold = np.mod(pos_fold, np.float32(boxsize_fold))
+                    if shift:
+                        pos_fold = pos_fold + np.float32(shift*boxsize_fold/gridsize)
+                    if outofcore:
+                        grid.add(pos_fold, weights)
+                    else:
+                        MAS_library.MA(
+                            np.require(pos_fold, np.float32, ['C', 'W']), grid,
+                            boxsize_fold, mas, W=weights, verbose=verbose,
+                        )
+        with measure('deposit'):
+            for key, delta in grids.items():
+                if outofcore:
+                    delta = grids[key] = delta.finish()
+                    mean = sum(
+                        np.sum(block, dtype=np.float64) for block in delta.blocks(rows)
+                    )/gridsize**3
+                    for block in delta.blocks(rows):
+                        block /= mean
+                        block -= 1
+                else:
+                    delta /= np.mean(delta, dtype=np.float64)
+                    delta -= 1
+        return grids
+    def get_delta_k(key, filename_or_pos, ptypes=None):
+        # Fourier space fields, one for each fold factor, when
+        # interlacing combined with the field of the particles
+        # shifted by half a grid cell. With checkpointing, the fields
+        # are saved once computed and restored by later runs.
+        filename_checkpoint = get_filename_checkpoint(key)
+        if checkpoint and os.path.isfile(filename_checkpoint):
+            print(f'Restoring density field from {os.path.relpath(filename_checkpoint)}')
+            with measure('checkpoint'):
+                return load_checkpoint(filename_checkpoint)
+        deltas = get_deltas(filename_or_pos, ptypes)
+        deltas_k = []
+        for factor in factors:
+            deltas_factor = [deltas.pop((factor, shift)) for shift in shifts]
+            with measure('fft', threads):
+                if outofcore:
+                    delta_k = slabs.fft_field(deltas_factor[0], mas, rows, threads, *deltas_factor[1:])
+                else:
+                    delta_k = fft_field(deltas_factor[0], mas, threads, *deltas_factor[1:])
+            deltas_k.append(delta_k)
+            del deltas_factor
+        if checkpoint:
+            with measure('checkpoint'):
+                save_checkpoint(filename_checkpoint, deltas_k)
+        return deltas_k
+    def get_filename_checkpoint(key):
+        # Checkpoints are kept within a directory of the group and are
+        # tied to the inputs and settings of the field
+        filenames_halo = []
+        if isinstance(key, tuple) and key[0] == 'halo':
+            filenames_halo.append(get_filename(mass, sim, code, z, 'halo_cdm'))
+        fingerprint = get_fingerprint(sim, filenames_snapshot, filenames_halo)
+        return f'{checkpoint_dir}/{get_hash([key, fingerprint])}'
+    def save_checkpoint(filename, deltas_k):
+        # The fields of all fold factors, stored back to back slab by slab
+        with open_atomic(filename) as f:
+            for delta_k in deltas_k:
+                for slab in delta_k:
+                    slab.tofile(f)
+    def load_checkpoint(filename):
+        deltas_k = []
+        with open(filename, 'rb') as f:
+            for factor in factors:
+                delta_k = allocate((gridsize, gridsize, gridsize//2 + 1), np.complex64)
+                for slab in delta_k:
+                    slab[...] = np.fromfile(
+                        f, dtype=slab.dtype, count=slab.size,
+                    ).reshape(slab.shape)
+                deltas_k.append(delta_k)
+        return deltas_k
+    def allocate(shape, dtype):
+        if outofcore:
+            return slabs.Grid(shape, dtype, scratch_dir)
+        return np.empty(shape, dtype=dtype)
+    def get_field(key):
+        # Density fields are kept in Fourier space (with the mass
+        # assignment deconvolved) for as long as any pending spectrum
+        # within the group needs them, as a list over the fold factors.
+        if key in fields:
+            return fields[key]
+        if isinstance(key, int):
+            print(f'Computing density field for {group_name} {ptype2species[key]}')
+            deltas_k = get_delta_k(key, filename_snapshot, [key])
+        elif key[0] == 'halo':
+            print(f'Computing density field for {group_name} {key[1]} halos')
+            with measure('read'):
+                _, pos = load_halo(mass, sim, code, z, 'cdm', threshold=key[1])
+            deltas_k = get_delta_k(key, pos)
+        elif all(header.massarr[ptype] > 0 for ptype in key):
+            # Combined field from the per-species fields,
+            # weighted by the mass fractions.
+            weights = header.massarr[list(key)]*header.nall[list(key)]
+            weights = weights/np.sum(weights)
+            print(
+                f'Combining density fields for {group_name} '
+                + ' + '.join(ptype2species[ptype] for ptype in key)
+            )
+            deltas_k = None
+            for ptype, weight in zip(key, weights):
+                deltas_k_ptype = get_field(ptype)
+                weight = np.float32(weight)
+                # Operate slab by slab to avoid temporary grids
+                with measure('combine'):
+                    if deltas_k is not None:
+                        for delta_k, delta_k_ptype in zip(deltas_k, deltas_k_ptype):
+                            for slab, slab_ptype in zip(delta_k, delta_k_ptype):
+                                slab += weight*slab_ptype
+                    elif uses[ptype] == 1:
+                        # Last use of this field, so reuse its memory
+                        deltas_k = deltas_k_ptype
+                        for delta_k in deltas_k:
+                            for slab in delta_k:
+                                slab *= weight
+                    else:
+                        deltas_k = []
+                        for delta_k_ptype in deltas_k_ptype:
+                            delta_k = allocate(delta_k_ptype.shape, delta_k_ptype.dtype)
+                            for slab, slab_ptype in zip(delta_k, delta_k_ptype):
+                                np.multiply(weight, slab_ptype, out=slab)
+                            deltas_k.append(delta_k)
+                release(ptype)
+        else:
+            # Particle masses not in the header
+            print(
+                f'Computing density field for {group_name} '
+                + ' + '.join(ptype2species[ptype] for ptype in key)
+            )
+            deltas_k = get_delta_k(key, filename_snapshot, list(key))
+        fields[key] = deltas_k
+        return deltas_k
+    def release(key):
+        uses[key] -= 1
+        if uses[key] == 0:
+            uses.pop(key)
+            fields.pop(key, None)
+    # Count the uses of each density field, with combined fields
+    # built from the per-species fields whenever possible
+    uses = collections.Counter()
+    for job in jobs:
+        for key in job.keys:
+            uses[key] += 1
+            if (
+                isinstance(key, tuple) and key[0] != 'halo'
+                and all(header.massarr[ptype] > 0 for ptype in key)
+            ):
+                uses.update(key)
+    # Compute density fields and power spectra
+    filenames_snapshot = gadget.open_snapshot(filename_snapshot).filenames
+    checkpoint_dir = f'{scratch_dir}/checkpoint/{get_hash(group_name)}'
+    fields = {}
+    for spectrum, spectrum_type, keys, filename_output, fingerprint in jobs:
+        data_name = f'{group_name} {spectrum}'
+        fields_job = [get_field(key) for key in keys]
+        print(f'Computing {spectrum_type} power spectrum for {data_name}')
+        spectra_folded = []
+        for factor, *deltas_k in zip(factors, *fields_job):
+            # The power of a folded box is reduced by the folded volume.
+            # In redshift space, the multipoles are accumulated within
+            # the same pass over the modes.
+            with measure('power'):
+                k, power, modes = get_power(
+                    deltas_k[0], boxsize/factor, *deltas_k[1:], axis=(axis if rsd else None),
+                )
+            spectra_folded.append((k, power*factor**3, modes))
+        del fields_job, deltas_k
+        k, power, modes, k_stitches = stitch(spectra_folded, boxsize, gridsize, fold_stitch)
+        for key in keys:
+            release(key)
         # Save power spectrum
         z_actual = header.redshift
         data_name = f'{sim_name} {code} z={z_actual} {spectrum}'
-        os.makedirs(os.path.dirname(filename_output), exist_ok=True)
-        np.savetxt(
-            filename_output, np.array((k, power, modes)).T,
-            header='\n'.join([
-                f'{spectrum_type.capitalize()} power spectrum for {data_name}',
-                f'{"k [h/Mpc]": <22} {"P [(Mpc/h)^3]": <24} modes',
-            ]),
-        )
+        header_lines = [
+            f'{spectrum_type.capitalize()} power spectrum for {data_name} '
+            f'({"interlaced "*interlaced}{mas})'
+        ]
+        if folds:
+            header_lines.append(
+                f'Folded by factors {", ".join(map(str, factors[1:]))}, stitched at '
+                f'k = {", ".join(f"{k_stitch:.6g}" for k_stitch in k_stitches)} h/Mpc'
+            )
+        columns = [k, power, modes]
+        header_columns = f'{"k [h/Mpc]": <22} {"P [(Mpc/h)^3]": <24} modes'
+        if rsd:
+            # Monopole as P, with the quadrupole and hexadecapole
+            # as additional columns
+            header_lines.append(
+                f'Redshift space along axis {axis}, with multipoles P0 (P), P2 and P4'
+            )
+            columns = [k, power[:, 0], modes, power[:, 1], power[:, 2]]
+            header_columns = (
+                f'{header_columns: <72} {"P2 [(Mpc/h)^3]": <24} P4 [(Mpc/h)^3]'
+            )
+        header_lines.append(f'Fingerprint: {json.dumps(fingerprint, separators=(",", ":"))}')
+        header_lines.append(header_columns)
+        # Any binary file of a previous run is removed first, as it
+        # would otherwise be read in place of the new text file
+        filename_binary = f'{filename_output}.npz'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filename_binary)
+        with measure('save'), open_atomic(filename_output) as f:
+            np.savetxt(f, np.array(columns).T, header='\n'.join(header_lines))
         print(f'Saved {os.path.relpath(filename_output)}')
+        if binary:
+            # Same data and typed header fields, read in preference
+            # to the text file by load_powerspec()
+            arrays = dict(zip(['k', 'power', 'modes', 'power2', 'power4'], columns))
+            with measure('save'), open_atomic(filename_binary) as f:
+                np.savez(
+                    f, **arrays, spectrum=spectrum, spectrum_type=spectrum_type,
+                    sim_name=sim_name, code=code, z=z_actual, header='\n'.join(header_lines),
+                    fingerprint=json.dumps(fingerprint),
+                )
+            print(f'Saved {os.path.relpath(filename_binary)}')
+        record(task, 'saved', spectrum=spectrum)
+    # No checkpoint of the group is needed once all spectra are saved,
+    # including those of fields not restored by this run
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    for stage, totals in stages.items():
+        write_profile(group_name, stage, totals)
+    print(f'Peak memory usage: {get_peak_memory():.2f} GB')
+
+# Reading of snapshots
+def iterate_particles(filename_snapshot, ptype, weighted=False, redshift_space=False):
+    # Positions in Mpc/h (and masses in Msun/h if weighted) of the
+    # particles of the given type, in chunks of at most chunksize
+    # particles, read from the memory mapped snapshot files. In redshift
+    # space, the positions are displaced along axis by the peculiar
+    # velocities, as in RSL.pos_redshift_space() of Pylians.
+    snapshot = gadget.open_snapshot(filename_snapshot)
+    header = snapshot.header
+    chunks_mass = itertools.repeat(None)
+    if weighted and header.massarr[ptype] == 0:
+        chunks_mass = snapshot.iterate('MASS', ptype, chunksize)
+    chunks_vel = itertools.repeat(None)
+    if redshift_space:
+        chunks_vel = snapshot.iterate('VEL ', ptype, chunksize)
+        # Conversion from GADGET velocities to displacements in Mpc/h
+        factor = np.float32(np.sqrt(header.time)*(1 + header.redshift)/header.Hubble)
+        boxsize = np.float32(header.boxsize/1e3)
+    for chunk_pos, chunk_mass, chunk_vel in zip(
+        snapshot.iterate('POS ', ptype, chunksize), chunks_mass, chunks_vel,
+    ):
+        pos = chunk_pos/np.float32(1e3)
+        if chunk_vel is not None:
+            pos[:, axis] += chunk_vel[:, axis]*factor
+            pos[:, axis] %= boxsize
+        weights = None
+        if chunk_mass is not None:
+            weights = chunk_mass*np.float32(1e10)
+        elif weighted:
+            weights = np.full(
+                len(pos), header.massarr[ptype]*1e10, dtype=np.float32,
+            )
+        yield pos, weights
 
 if __name__ == '__main__':
     compute(masses, simulations, codes, redshifts, spectra, recompute)
-
@@ -25,12 +25,12 @@ filename_figure = f'{this_dir}/../figure/figure10.pdf'
 
 # Main function
 def plot(masses, sim, codes, z, spectrum, reference, filename_figure):
-    def get_bispec(mass, sim, code, z, spectrum, configuration_expr, k_desired):
+    def get_bispec(mass, sim, code, z, spectrum, legs, k_desired):
         if code == 'treelevel':
             bpower = get_bispec_treelevel(mass, z, spectrum, [k1, k2, k3], configuration.k_plot)
             return k1, k2, k3, bpower
         k1_read, k2_read, k3_read, bpower, _ = load_bispec(
-            mass, sim, code, z, spectrum, configuration_expr, k_desired,
+            mass, sim, code, z, spectrum, legs, k_desired,
         )
         return k1_read, k2_read, k3_read, bpower
     # Load and plot
@@ -53,12 +53,12 @@ def plot(masses, sim, codes, z, spectrum, reference, filename_figure):
     }
     Configuration = collections.namedtuple(
         'Configuration',
-        ['panel', 'expr', 'k_plot', 'title', 'k_desired'],
+        ['panel', 'legs', 'k_plot', 'title', 'k_desired'],
         defaults=[None],
     )
     configurations = {
         'squeezed': Configuration(
-            axes[:4, 0], lambda k1, k2, k3: (k1 == k2) & (k3 == k_fixed['squeezed'][2]), 1,
+            axes[:4, 0], ('k', 'k', k_fixed['squeezed'][2]), 1,
             (
                 rf'Squeezed triangles: $k_1=k_2\equiv k$, '
                 rf'$k_3 = {k_fixed["squeezed"][2]*k_fundamental:.2g}\, h\, \mathrm{{Mpc}}^{{-1}}$'
@@ -66,19 +66,19 @@ def plot(masses, sim, codes, z, spectrum, reference, filename_figure):
             k_desired,
         ),
         'equilateral': Configuration(
-            axes[ :4, 1], lambda k1, k2, k3: (k1 == k2) & (k2 == k3), 1,
+            axes[ :4, 1], ('k', 'k', 'k'), 1,
             r'Equilateral triangles: $k_1=k_2=k_3 \equiv k$',
             k_desired,
         ),
         'scaleneA': Configuration(
-            axes[5:9, 0], lambda k1, k2, k3: (k1 == k_fixed['scaleneA'][0]) & (k2 == k_fixed['scaleneA'][1]), 3,
+            axes[5:9, 0], tuple(k_fixed['scaleneA']), 3,
             (
                 rf'Scalene triangles: $k_1={k_fixed["scaleneA"][0]*k_fundamental:.2g}\, h\, \mathrm{{Mpc}}^{{-1}}$, '
                 rf'$k_2={k_fixed["scaleneA"][1]*k_fundamental:.2g}\, h\, \mathrm{{Mpc}}^{{-1}}$'
             ),
         ),
         'scaleneB': Configuration(
-            axes[5:9, 1], lambda k1, k2, k3: (k1 == k_fixed['scaleneB'][0]) & (k3 == k_fixed['scaleneB'][2]), 2,
+            axes[5:9, 1], tuple(k_fixed['scaleneB']), 2,
             (
                 rf'Scalene triangles: $k_1={k_fixed["scaleneB"][0]*k_fundamental:.2g}\, h\, \mathrm{{Mpc}}^{{-1}}$, '
                 rf'$k_3={k_fixed["scaleneB"][2]*k_fundamental:.2g}\, h\, \mathrm{{Mpc}}^{{-1}}$'
@@ -87,21 +87,21 @@ def plot(masses, sim, codes, z, spectrum, reference, filename_figure):
     }
     for configuration in configurations.values():
         k1, k2, k3, bpower_0_ref = get_bispec(
-            0, sim, reference, z, spectrum, configuration.expr, configuration.k_desired,
+            0, sim, reference, z, spectrum, configuration.legs, configuration.k_desired,
         )
         ratios_ref = {}
         for mass in masses:
             _, _, _, bpower_ref = get_bispec(
-                mass, sim, reference, z, spectrum, configuration.expr, configuration.k_desired,
+                mass, sim, reference, z, spectrum, configuration.legs, configuration.k_desired,
             )
             ratios_ref[mass] = bpower_ref/bpower_0_ref
         for code in codes:
             _, _, _, bpower_0 = get_bispec(
-                0, sim, code, z, spectrum, configuration.expr, configuration.k_desired,
+                0, sim, code, z, spectrum, configuration.legs, configuration.k_desired,
             )
             for i, mass in enumerate(masses):
                 _, _, _, bpower = get_bispec(
-                    mass, sim, code, z, spectrum, configuration.expr, configuration.k_desired,
+                    mass, sim, code, z, spectrum, configuration.legs, configuration.k_desired,
                 )
                 # Upper subpanel
                 ratio = bpower/bpower_0
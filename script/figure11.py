@@ -24,12 +24,12 @@ filename_figure = f'{this_dir}/../figure/figure11.pdf'
 
 # Main function
 def plot(mass, simulations, codes, z, spectrum, reference, filename_figure):
-    def get_bispec(mass, sim, code, z, spectrum, configuration_expr, k_desired):
+    def get_bispec(mass, sim, code, z, spectrum, legs, k_desired):
         if code == 'treelevel':
             bpower = get_bispec_treelevel(mass, z, spectrum, [k1, k2, k3], k_plot)
             return k1, k2, k3, bpower
         k1_read, k2_read, k3_read, bpower, _ = load_bispec(
-            mass, sim, code, z, spectrum, configuration_expr, k_desired,
+            mass, sim, code, z, spectrum, legs, k_desired,
         )
         return k1_read, k2_read, k3_read, bpower
     # Load and plot
@@ -39,20 +39,20 @@ def plot(mass, simulations, codes, z, spectrum, reference, filename_figure):
     for sim, ax in zip(simulations, axes):
         boxsize, _ = get_boxgrid(sim)
         k_fixed = 1*(boxsize//512)
-        configuration_expr = lambda k1, k2, k3: (k1 == k2) & (k3 == k_fixed)
+        legs = ('k', 'k', k_fixed)  # squeezed triangles k1 = k2, k3 = k_fixed
         k1, k2, k3, bpower_0_ref = get_bispec(
-            0, sim, reference, z, spectrum, configuration_expr, k_desired,
+            0, sim, reference, z, spectrum, legs, k_desired,
         )
         _, _, _, bpower_ref = get_bispec(
-            mass, sim, reference, z, spectrum, configuration_expr, k_desired,
+            mass, sim, reference, z, spectrum, legs, k_desired,
         )
         ratio_ref = bpower_ref/bpower_0_ref
         for code in codes:
             _, _, _, bpower_0 = get_bispec(
-                0, sim, code, z, spectrum, configuration_expr, k_desired,
+                0, sim, code, z, spectrum, legs, k_desired,
             )
             _, _, _, bpower = get_bispec(
-                mass, sim, code, z, spectrum, configuration_expr, k_desired,
+                mass, sim, code, z, spectrum, legs, k_desired,
             )
             ratio = bpower/bpower_0
             ax.semilogx((k1, k2, k3)[k_plot - 1], ratio/ratio_ref - 1, **get_plot_kwargs(code))
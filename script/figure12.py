@@ -30,14 +30,13 @@ def plot(mass, simulations, codes, z, spectrum, reference, filename_figure):
     fig, axes = plt.subplots(1, len(simulations))
     bins = np.logspace(11.7, 15, 15)
     for sim, ax in zip(simulations, axes):
-        bin_centers, counts_ref = load_halo(
-            mass, sim, reference, z, spectrum, bins=bins,
+        bin_centers, counts_all = load_hmf(
+            [(mass, sim, code, z) for code in [reference] + codes],
+            spectrum, bins,
         )
+        counts_ref = counts_all[0]
         mask = (counts_ref != 0)
-        for code in codes:
-            _, counts = load_halo(
-                mass, sim, code, z, spectrum, bins=bins,
-            )
+        for code, counts in zip(codes, counts_all[1:]):
             ax.semilogx(
                 bin_centers[mask], counts[mask]/counts_ref[mask] - 1,
                 **get_plot_kwargs(code),
@@ -29,14 +29,16 @@ def plot(masses, sim, codes, redshifts, spectrum, filename_figure):
     fig, axes = plt.subplots(1, len(redshifts))
     bins = np.logspace(11.7, 15, 10)
     for z, ax in zip(redshifts, axes):
-        for code in codes:
-            bin_centers, counts_0 = load_halo(
-                0, sim, code, z, spectrum, bins=bins,
-            )
-            for i, mass in enumerate(masses):
-                bin_centers, counts = load_halo(
-                    mass, sim, code, z, spectrum, bins=bins,
-                )
+        bin_centers, counts_all = load_hmf(
+            [
+                (mass, sim, code, z)
+                for code in codes for mass in [0] + masses
+            ],
+            spectrum, bins,
+        )
+        counts_all = counts_all.reshape(len(codes), 1 + len(masses), -1)
+        for code, (counts_0, *counts_masses) in zip(codes, counts_all):
+            for i, counts in enumerate(counts_masses):
                 ax.semilogx(
                     bin_centers, counts/counts_0,
                     **get_plot_kwargs(code, pop='label'*(i != 0)),
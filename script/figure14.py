@@ -30,20 +30,17 @@ def plot(mass, simulations, codes, z, spectrum, reference, filename_figure):
     fig, axes = plt.subplots(1, len(simulations))
     bins = np.logspace(11.7, 15, 10)
     for sim, ax in zip(simulations, axes):
-        bin_centers, counts_0_ref = load_halo(
-            0, sim, reference, z, spectrum, bins=bins,
-        )
-        _, counts_ref = load_halo(
-            mass, sim, reference, z, spectrum, bins=bins,
+        bin_centers, counts_all = load_hmf(
+            [
+                (m, sim, code, z)
+                for code in [reference] + codes for m in [0, mass]
+            ],
+            spectrum, bins,
         )
+        counts_all = counts_all.reshape(1 + len(codes), 2, -1)
+        counts_0_ref, counts_ref = counts_all[0]
         ratio_ref = counts_ref/counts_0_ref
-        for code in codes:
-            _, counts_0 = load_halo(
-                0, sim, code, z, spectrum, bins=bins,
-            )
-            _, counts = load_halo(
-                mass, sim, code, z, spectrum, bins=bins,
-            )
+        for code, (counts_0, counts) in zip(codes, counts_all[1:]):
             ratio = counts/counts_0
             ax.semilogx(
                 bin_centers, ratio/ratio_ref - 1,
@@ -28,15 +28,15 @@ def plot(mass, sim, codes, redshifts, spectrum, reference, filename_figure):
     fig, axes = plt.subplots(1, len(redshifts))
     k_desired = np.logspace(np.log10(1e-2), np.log10(1e+1), 30)
     k_fixed = 1
-    configuration_expr = lambda k1, k2, k3: (k1 == k2) & (k3 == k_fixed)
+    legs = ('k', 'k', k_fixed)  # squeezed triangles k1 = k2, k3 = k_fixed
     k_plot = 1
     for z, ax in zip(redshifts, axes):
         k1, k2, k3, bpower_ref, _ = load_bispec(
-            mass, sim, reference, z, spectrum, configuration_expr, k_desired,
+            mass, sim, reference, z, spectrum, legs, k_desired,
         )
         for code in codes:
             _, _, _, bpower, _ = load_bispec(
-                mass, sim, code, z, spectrum, configuration_expr, k_desired,
+                mass, sim, code, z, spectrum, legs, k_desired,
             )
             ax.semilogx(
                 (k1, k2, k3)[k_plot - 1],
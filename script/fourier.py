@@ -0,0 +1,215 @@
+import collections, functools
+import numpy as np
+import scipy.fft
+
+# Orders of the mass assignment schemes
+mas_orders = {'NGP': 1, 'CIC': 2, 'TSC': 3, 'PCS': 4}
+
+# Functions for computing power spectra from Fourier space fields,
+# following the conventions of Pylians.
+def new_grid(gridsize):
+    # Zeroed real space grid, padded along the last axis
+    # so that fft_field() can transform it in place
+    padded = np.zeros((gridsize, gridsize, 2*(gridsize//2 + 1)), dtype=np.float32)
+    return padded[:, :, :gridsize]
+def fft_field(delta, mas, threads=1, delta_shifted=None):
+    # Real-to-complex transform of delta with the mass assignment
+    # deconvolved, of shape (gridsize, gridsize, gridsize//2 + 1).
+    # If given, delta_shifted is interlaced with delta. Grids from
+    # new_grid() are transformed in place, after which they
+    # should no longer be used.
+    delta_k = rfftn(delta, threads)
+    if delta_shifted is not None:
+        interlace(delta_k, rfftn(delta_shifted, threads))
+    deconvolve(delta_k, mas)
+    return delta_k
+def rfftn(delta, threads=1):
+    gridsize = delta.shape[-1]
+    padded = delta.base
+    if (
+        padded is None or padded.dtype != np.float32
+        or padded.shape != delta.shape[:-1] + (2*(gridsize//2 + 1), )
+        or padded.strides != delta.strides or padded.ctypes.data != delta.ctypes.data
+    ):
+        return scipy.fft.rfftn(delta, workers=threads)
+    # In-place transform, first along the last axis slab by slab and
+    # then along the remaining axes, identical to scipy.fft.rfftn()
+    delta_k = padded.view(np.complex64)
+    for i, slab in enumerate(delta):
+        delta_k[i] = scipy.fft.rfft(slab, axis=-1, workers=threads)
+    return scipy.fft.fftn(delta_k, axes=(0, 1), overwrite_x=True, workers=threads)
+def interlace(delta_k, delta_k_shifted):
+    # Average delta_k with delta_k_shifted, the latter obtained from
+    # the particles shifted by half a grid cell along each axis. The
+    # shift is undone by a phase, after which the aliased contributions
+    # of odd multiples of the grid frequency cancel.
+    phase = get_phase(delta_k.shape[0])
+    phase_z = phase[:delta_k.shape[2]]
+    for phase_x, slab, slab_shifted in zip(phase, delta_k, delta_k_shifted):
+        slab_shifted *= ((phase_x*phase[:, None])*phase_z[None, :]).astype(slab.dtype)
+        slab += slab_shifted
+        slab *= 0.5
+@functools.lru_cache
+def get_phase(gridsize):
+    # Phase undoing a shift by half a grid cell along an axis
+    phase = np.exp(1j*np.pi/gridsize*get_wavenumbers(gridsize))
+    phase.flags.writeable = False
+    return phase
+def deconvolve(delta_k, mas):
+    # As in Pylians, the correction is computed in double precision
+    # but applied in single precision.
+    correction = get_correction(delta_k.shape[0], mas)
+    correction_z = correction[:delta_k.shape[2]]
+    for correction_x, slab in zip(correction, delta_k):
+        slab *= (
+            (correction_x*correction[:, None])*correction_z[None, :]
+        ).astype(slab.real.dtype)
+@functools.lru_cache
+def get_correction(gridsize, mas):
+    # Mass assignment correction along an axis
+    x = np.pi/gridsize*get_wavenumbers(gridsize)
+    correction = np.ones(gridsize)
+    nonzero = (x != 0)
+    correction[nonzero] = (x[nonzero]/np.sin(x[nonzero]))**mas_orders[mas]
+    correction.flags.writeable = False
+    return correction
+def get_power(delta_k, boxsize, delta_k2=None, k_desired=None, axis=None):
+    # Auto power spectrum of delta_k, or cross power spectrum of delta_k
+    # and delta_k2, binned in shells of integer |k| (in units of the
+    # fundamental frequency). The returned k, power and modes correspond
+    # to k3D, Pk[:, 0] (XPk[:, 0, 0]) and Nmodes3D of Pylians. If bin
+    # edges k_desired (in h/Mpc, e.g. logarithmically spaced) are given,
+    # the modes are instead binned directly into these, with the empty
+    # bins left out. If axis is given, power instead holds the monopole,
+    # quadrupole and hexadecapole with respect to this axis as its
+    # columns, as Pk[:, :3] (XPk[:, :3, 0]) of Pylians.
+    gridsize = delta_k.shape[0]
+    edges = None
+    if k_desired is not None:
+        edges = tuple(np.asarray(k_desired, dtype=np.float64)/(2*np.pi/boxsize))
+    shells = get_shell_index(gridsize, edges)
+    power = np.zeros((1 if axis is None else 3, shells.kmax + 2))
+    for kxx, slab in enumerate(delta_k):
+        slab2 = (slab if delta_k2 is None else delta_k2[kxx])
+        product = (
+            slab.real.astype(np.float64)*slab2.real
+            + slab.imag.astype(np.float64)*slab2.imag
+        ).ravel()
+        index = get_shell_slab(shells, kxx).ravel()
+        power[0] += np.bincount(index, weights=product, minlength=power.shape[1])
+        if axis is None:
+            continue
+        # Legendre polynomials weighted by 2l + 1
+        mu2 = get_mu2(shells, kxx, axis).ravel()
+        power[1] += np.bincount(
+            index, weights=product*(7.5*mu2 - 2.5), minlength=power.shape[1],
+        )
+        power[2] += np.bincount(
+            index, weights=product*((39.375*mu2 - 33.75)*mu2 + 3.375),
+            minlength=power.shape[1],
+        )
+    # Discard DC mode bin (as well as the bin of skipped modes)
+    # and give units.
+    with np.errstate(invalid='ignore'):
+        power = (power[:, 1:-1]/shells.modes)*(boxsize/gridsize**2)**3
+    power = (power[0] if axis is None else power.T)
+    k = shells.k*(2*np.pi/boxsize)
+    modes = shells.modes
+    if edges is not None:
+        mask = (modes > 0)
+        k, power, modes = k[mask], power[mask], modes[mask]
+    return k, power, modes
+def stitch(spectra, boxsize, gridsize, fraction):
+    # Combine the spectra (k, power, modes) of boxes folded by factors
+    # 1, 2, 4, ..., switching from one to the next at the given fraction
+    # of the Nyquist frequency of the former. Returns the combined
+    # spectrum along with the k of the stitch points.
+    k_stitches = [
+        fraction*np.pi*gridsize*2**i/boxsize for i in range(len(spectra) - 1)
+    ]
+    bounds = [0] + k_stitches + [np.inf]
+    parts = []
+    for (k, power, modes), k_lower, k_upper in zip(spectra, bounds[:-1], bounds[1:]):
+        mask = (k_lower <= k) & (k < k_upper)
+        parts.append((k[mask], power[mask], modes[mask]))
+    k, power, modes = [np.concatenate(arrays) for arrays in zip(*parts)]
+    return k, power, modes, k_stitches
+ShellIndex = collections.namedtuple(
+    'ShellIndex', ('k2', 'shell', 'skip', 'k', 'modes', 'kmax'),
+)
+@functools.lru_cache
+def get_shell_index(gridsize, edges=None):
+    # The |k| shell of each mode is looked up from its integer k²,
+    # which within a slab of fixed kx is given by the (ky, kz) plane.
+    # Modes redundant due to Hermitian symmetry are mapped to the
+    # additional bin kmax + 1. With bin edges (in units of the
+    # fundamental frequency) given, the shells are these bins instead,
+    # numbered from 1, with modes below (above) the edges mapped to
+    # bin 0 (kmax + 1).
+    middle = gridsize//2
+    ky = get_wavenumbers(gridsize)[:, None]
+    kz = np.arange(middle + 1)[None, :]
+    k2 = ky**2 + kz**2
+    if edges is None:
+        kmax = int(np.sqrt(3*middle**2))
+        shell = np.sqrt(np.arange(3*middle**2 + 1)).astype(np.intp)
+    else:
+        # Bins include their lower edge, with the last bin
+        # also including its upper edge, as in np.histogram().
+        kmax = len(edges) - 1
+        k_abs = np.sqrt(np.arange(3*middle**2 + 1))
+        shell = np.searchsorted(edges, k_abs, 'right')
+        shell[k_abs == edges[-1]] = kmax
+        shell[0] = 0  # DC mode
+    special = np.broadcast_to(
+        (kz == 0) | ((kz == middle) & (gridsize%2 == 0)), k2.shape,
+    )
+    skip = {
+        'negative': special,
+        'boundary': special & (ky < 0),
+    }
+    shells = ShellIndex(k2, shell, skip, None, None, kmax)
+    # Count the modes and their mean |k| within each shell
+    modes = np.zeros(kmax + 2)
+    k = np.zeros(kmax + 2)
+    for kxx, kx in enumerate(get_wavenumbers(gridsize)):
+        index = get_shell_slab(shells, kxx).ravel()
+        modes += np.bincount(index, minlength=modes.size)
+        k += np.bincount(
+            index, weights=np.sqrt(kx**2 + k2).ravel(), minlength=k.size,
+        )
+    modes = modes[1:-1]
+    with np.errstate(invalid='ignore'):
+        k = k[1:-1]/modes
+    return shells._replace(k=k, modes=modes)
+def get_shell_slab(shells, kxx):
+    gridsize = shells.k2.shape[0]
+    middle = gridsize//2
+    kx = get_wavenumbers(gridsize)[kxx]
+    index = shells.shell[kx**2 + shells.k2]
+    # Skip modes redundant due to Hermitian symmetry
+    if kx < 0:
+        index[shells.skip['negative']] = shells.kmax + 1
+    elif kx == 0 or (kx == middle and gridsize%2 == 0):
+        index[shells.skip['boundary']] = shells.kmax + 1
+    return index
+def get_mu2(shells, kxx, axis):
+    # Squared cosine of the angle between the modes of a slab and the
+    # given axis, set to zero for the DC mode
+    gridsize = shells.k2.shape[0]
+    kx = get_wavenumbers(gridsize)[kxx]
+    k_axis = [
+        kx,
+        get_wavenumbers(gridsize)[:, None],
+        np.arange(gridsize//2 + 1)[None, :],
+    ][axis]
+    mu2 = k_axis**2/np.maximum(kx**2 + shells.k2, 1)
+    return np.broadcast_to(mu2, shells.k2.shape)
+@functools.lru_cache
+def get_wavenumbers(gridsize):
+    # Integer wavenumbers along an axis in units of the fundamental
+    # frequency, with the Nyquist frequency counted as positive.
+    k = np.arange(gridsize)
+    k[k > gridsize//2] -= gridsize
+    k.flags.writeable = False
+    return k
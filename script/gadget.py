@@ -0,0 +1,164 @@
+import collections, functools, math, os
+import numpy as np
+
+# Reader of (multi-file) GADGET format 1 and 2 snapshots. Headers and
+# block offsets of all files are parsed once, with the data blocks then
+# exposed as read-only memory mapped views. The header() and
+# read_block() functions mirror those of readgadget (Pylians).
+
+# Block order of format 1 snapshots, which carry no block names
+blocks_format1 = ['HEAD', 'POS ', 'VEL ', 'ID  ', 'MASS']
+
+# Header layout
+header_dtype = np.dtype([
+    ('npart',           'i4', 6),
+    ('massarr',         'f8', 6),
+    ('time',            'f8'),
+    ('redshift',        'f8'),
+    ('flag_sfr',        'i4'),
+    ('flag_feedback',   'i4'),
+    ('nall',            'u4', 6),
+    ('flag_cooling',    'i4'),
+    ('num_files',       'i4'),
+    ('boxsize',         'f8'),
+    ('omega_m',         'f8'),
+    ('omega_l',         'f8'),
+    ('hubble',          'f8'),
+    ('flag_stellarage', 'i4'),
+    ('flag_metals',     'i4'),
+    ('nall_hw',         'u4', 6),
+])
+
+# Snapshot header, with the attributes of readgadget.header
+Header = collections.namedtuple(
+    'Header',
+    (
+        'time', 'redshift', 'boxsize', 'filenum', 'omega_m', 'omega_l',
+        'hubble', 'massarr', 'npart', 'nall', 'cooling', 'format', 'Hubble',
+    ),
+)
+
+# Functions mirroring readgadget
+def header(snapshot):
+    return open_snapshot(snapshot).header
+def read_field(snapshot, block, ptype):
+    # Copy of block of a single snapshot file
+    return np.array(open_snapshot(snapshot).get_views(block, ptype)[0])
+def read_block(snapshot, block, ptypes):
+    # Block of the given particle types, concatenated over all files.
+    # As with readgadget, velocities are converted to peculiar velocities.
+    snapshot = open_snapshot(snapshot)
+    views = [view for ptype in ptypes for view in snapshot.get_views(block, ptype)]
+    if not views:
+        return np.empty(0, dtype=np.float32)
+    data = np.concatenate(views)
+    if block == 'VEL ' and snapshot.header.redshift != 0:
+        data *= math.sqrt(snapshot.header.time)
+    return data
+
+# Snapshot
+@functools.lru_cache
+def open_snapshot(snapshot):
+    return Snapshot(snapshot)
+class Snapshot:
+    def __init__(self, snapshot):
+        if os.path.isfile(snapshot):
+            filename = snapshot
+        elif os.path.isfile(f'{snapshot}.0'):
+            filename = f'{snapshot}.0'
+        else:
+            raise FileNotFoundError(f'No snapshot {snapshot}')
+        header, layout = read_layout(filename)
+        self.filenames = [filename]
+        self.headers = [header]
+        self.layouts = [layout]
+        for i in range(1, header.filenum):
+            filename = f'{snapshot}.{i}'
+            header, layout = read_layout(filename)
+            self.filenames.append(filename)
+            self.headers.append(header)
+            self.layouts.append(layout)
+        self.header = self.headers[0]
+    def get_views(self, block, ptype):
+        # Block of a given particle type as memory mapped views,
+        # one for each file
+        return [self.get_view(block, ptype, i) for i in range(len(self.filenames))]
+    def get_view(self, block, ptype, i):
+        header = self.headers[i]
+        byteorder, layout = self.layouts[i]
+        # The mass block only contains types without a fixed mass
+        has_data = np.ones(6, dtype=bool)
+        if block == 'MASS':
+            has_data = (header.massarr == 0)
+            if not has_data[ptype]:
+                raise ValueError(f'No masses of particle type {ptype} in {self.filenames[i]}')
+        npart = np.where(has_data, header.npart, 0)
+        offset, size = layout[block]
+        itemsize = size//max(1, np.sum(npart))
+        if block in {'POS ', 'VEL '}:
+            dtype, shape = np.dtype(f'{byteorder}f4'), (3, )
+        elif block == 'ID  ':
+            dtype, shape = np.dtype(f'{byteorder}u{itemsize}'), ()
+        else:
+            dtype, shape = np.dtype(f'{byteorder}f4'), ()
+        if npart[ptype] == 0:
+            return np.empty((0, ) + shape, dtype=dtype)
+        offset += dtype.itemsize*int(np.prod(shape))*int(np.sum(npart[:ptype]))
+        return np.memmap(
+            self.filenames[i], dtype=dtype, mode='r', offset=offset,
+            shape=(int(npart[ptype]), ) + shape,
+        )
+    def iterate(self, block, ptype, chunksize):
+        # Block of a given particle type as chunks of views
+        # (of at most chunksize particles), going through the files
+        for view in self.get_views(block, ptype):
+            for start in range(0, view.shape[0], chunksize):
+                yield view[start:start+chunksize]
+def read_layout(filename):
+    # Header and byte order of a snapshot file, along with the offsets
+    # and sizes of its data blocks, found by walking the record markers
+    filesize = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        marker = np.fromfile(f, dtype='<i4', count=1)[0]
+        byteorder = '<'
+        if marker not in {8, 256}:
+            byteorder = '>'
+            marker = marker.byteswap()
+        fmt = (2 if marker == 8 else 1)
+        layout = {}
+        offset = 0
+        n = 0
+        while offset < filesize:
+            f.seek(offset)
+            if fmt == 2:
+                # Name record preceding each block
+                f.seek(4, os.SEEK_CUR)
+                name = f.read(4).decode()
+                f.seek(8, os.SEEK_CUR)
+            else:
+                name = (blocks_format1[n] if n < len(blocks_format1) else f'{n}')
+            size = int(np.fromfile(f, dtype=f'{byteorder}u4', count=1)[0])
+            layout[name] = (f.tell(), size)
+            offset = f.tell() + size + 4
+            n += 1
+        f.seek(layout['HEAD'][0])
+        head = np.fromfile(f, dtype=header_dtype.newbyteorder(byteorder), count=1)[0]
+    nall = head['nall'].astype(np.int64) + (head['nall_hw'].astype(np.int64) << 32)
+    header = Header(
+        time=float(head['time']),
+        redshift=float(head['redshift']),
+        boxsize=float(head['boxsize']),
+        filenum=int(head['num_files']),
+        omega_m=float(head['omega_m']),
+        omega_l=float(head['omega_l']),
+        hubble=float(head['hubble']),
+        massarr=head['massarr'].astype(np.float64),
+        npart=head['npart'].astype(np.int64),
+        nall=nall,
+        cooling=int(head['flag_cooling']),
+        format=fmt,
+        Hubble=100*np.sqrt(
+            head['omega_m']*(1 + head['redshift'])**3 + head['omega_l']
+        ),
+    )
+    return header, (byteorder, layout)
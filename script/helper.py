@@ -1,17 +1,27 @@
-import collections, contextlib, functools, itertools, io, os, re, sys
+import collections, concurrent.futures, contextlib, functools, hashlib, inspect, itertools, io, json, os, re, sys, tempfile
 from glob import glob
 import numpy as np
 import matplotlib; matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import matplotlib.ticker
-import scipy.interpolate
-import classy                               # CLASS
-import readgadget, MAS_library, Pk_library  # Pylians
+import scipy.interpolate, scipy.sparse
+import classy                   # CLASS
+import MAS_library, Pk_library  # Pylians
 
 
 # Absolute path to the script directory
 this_dir = os.path.dirname(os.path.abspath(__file__))
 
+# Data directory and directory for on-disk caches of derived data
+data_dir = os.path.normpath(f'{this_dir}/../data')
+cache_dir = f'{data_dir}/.cache'
+
+# Backend from which data files are loaded; either the original
+# text files ('text') or the consolidated HDF5 store ('store'),
+# the latter of which is built by pack_data.py.
+backend = os.environ.get('NUCODECOMP_BACKEND', 'text')
+filename_store = f'{data_dir}/store.h5'
+
 # Set up Matplotlib
 plt.rcParams.update({
     'figure.figsize': (9, 4.5),  # default, changed by some figures
@@ -56,66 +66,177 @@ codespecs = {
     'despali16':       CodeSpec('despali16',       r'\texttt{Despali16}',                        '#595959', 'dotted', is_simulation=False),
 }
 
-# Patch part of Pylians to suppress unwanted output to screen
-def patch_pylians(lib, funcname, silence=()):
-    def _func(*args, **kwargs):
-        with contextlib.redirect_stdout(io.StringIO()) as f:
-            results = func_ori(*args, **kwargs)
-        lines = f.getvalue().strip().split('\n')
-        for line in lines:
-            if not line:
-                continue
-            if any(line.startswith(s) for s in silence):
-                continue
-            print(line)
-        return results
-    func_ori = getattr(lib, funcname)
-    setattr(lib, funcname, _func)
-patch_pylians(Pk_library, 'expected_Pk', ['Time'])
-patch_pylians(Pk_library, 'XPk', ['Time', 'Computing'])
+# In-memory LRU cache for results of the load_*() functions,
+# bounded by the total number of bytes of the cached arrays.
+# Cached arrays are read-only, protecting them from modification.
+result_cache_maxbytes = 2**30
+result_cache = collections.OrderedDict()
+ResultCacheInfo = collections.namedtuple(
+    'ResultCacheInfo',
+    ('hits', 'misses', 'evictions', 'entries', 'nbytes', 'maxbytes'),
+)
+result_cache_stats = collections.Counter()
+def cache_result(func):
+    @functools.wraps(func)
+    def cached_func(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (func.__name__, tuple(get_key(val) for val in bound.arguments.values()))
+        try:
+            result = result_cache.pop(key)
+        except TypeError:
+            # Unhashable argument
+            return func(*args, **kwargs)
+        except KeyError:
+            pass
+        else:
+            result_cache[key] = result
+            result_cache_stats['hits'] += 1
+            return result
+        result_cache_stats['misses'] += 1
+        result = []
+        for val in func(*args, **kwargs):
+            if isinstance(val, np.ndarray):
+                if any(val is arg for arg in bound.arguments.values()):
+                    val = val.copy()
+                val = val.view()
+                val.flags.writeable = False
+            result.append(val)
+        result = tuple(result)
+        nbytes = sum(val.nbytes for val in result if isinstance(val, np.ndarray))
+        if nbytes <= result_cache_maxbytes:
+            result_cache[key] = result
+            result_cache_stats['nbytes'] += nbytes
+            while result_cache_stats['nbytes'] > result_cache_maxbytes:
+                _, result_evicted = result_cache.popitem(last=False)
+                result_cache_stats['nbytes'] -= sum(
+                    val.nbytes for val in result_evicted if isinstance(val, np.ndarray)
+                )
+                result_cache_stats['evictions'] += 1
+        return result
+    signature = inspect.signature(func)
+    return cached_func
+def get_result_cache_info():
+    return ResultCacheInfo(
+        result_cache_stats['hits'],
+        result_cache_stats['misses'],
+        result_cache_stats['evictions'],
+        len(result_cache),
+        result_cache_stats['nbytes'],
+        result_cache_maxbytes,
+    )
+
+# Cache of k binning used by rebin(), see get_rebinner()
+rebinners = collections.OrderedDict()
+rebinners_maxsize = 64
+rebin_blocksize = 2**16  # as used by np.histogram()
 
 # Helper functions used by the figure scripts
+@cache_result
 def load_halo(
     mass, sim, code, z, spectrum, *,
     threshold=None, bins=None,
 ):
-    # For a few codes we have the precomputed halo mass function stored
-    filename = get_filename(mass, sim, code, z, f'hmf_{spectrum}')
-    if bins is not None and os.path.isfile(filename):
-        counts, bin_edges = np.histogram(1, bins=bins)
-        bin_centers = np.sqrt(bin_edges[1:]*bin_edges[:-1])
-        bin_centers_file, hmf = loadtxt(
-            mass, sim, code, z, f'hmf_{spectrum}', unpack=True,
+    if bins is not None:
+        # Return halo mass function
+        bin_centers, counts = load_hmf(
+            [(mass, sim, code, z)], spectrum, bins, threshold=threshold,
         )
-        hmf = np.exp(
-            scipy.interpolate.interp1d(
-                np.log(bin_centers_file), np.log(hmf),
-                kind='linear', fill_value='extrapolate',
-            )(np.log(bin_centers))
-        )
-        boxsize, _ = get_boxgrid(sim)
-        counts = hmf*boxsize**3*np.diff(bins)/bin_centers
-        return bin_centers, counts
-    # For most codes we have the halo catalogs stored
-    halomasses, x, y, z = loadtxt(
-        mass, sim, code, z, f'halo_{spectrum}', dtype=np.float32, unpack=True,
-    )
-    pos = np.array((x, y, z)).T
+        return bin_centers, counts[0]
+    halomasses, pos = get_halo_catalog(mass, sim, code, z, spectrum)
     if threshold is not None:
-        if isinstance(threshold, int):
-            # Select the `threshold` most massive halos
-            selection = halomasses.argsort()[-threshold:]
-        else:
-            # Select halos with masses above `threshold`
-            selection = (halomasses > float(threshold))
+        # Halos are sorted by descending mass, so any selection is a slice
+        selection = slice(count_halos(mass, sim, code, z, spectrum, threshold))
         halomasses = halomasses[selection]
         pos = pos[selection]
-    if bins is None:
-        return halomasses, pos
-    # Return halo mass function
-    counts, bin_edges = np.histogram(halomasses, bins=bins)
-    bin_centers = np.sqrt(bin_edges[1:]*bin_edges[:-1])
+    return halomasses, pos
+@cache_result
+def load_hmf(specs, spectrum, bins, *, threshold=None):
+    # Halo counts within the mass bins for each (mass, sim, code, z)
+    # in specs, as a matrix of shape (len(specs), len(bins) - 1).
+    # Counts from catalogs are integers, as with np.histogram(), while
+    # counts from precomputed tables are expected (fractional) counts.
+    bins = np.asarray(bins, dtype=float)
+    bin_centers = np.sqrt(bins[1:]*bins[:-1])
+    counts = np.empty((len(specs), bins.size - 1), dtype=np.int64)
+    tables = collections.defaultdict(list)
+    for i, (mass, sim, code, z) in enumerate(specs):
+        # For a few codes we have the precomputed halo mass function stored
+        filename = get_filename(mass, sim, code, z, f'hmf_{spectrum}')
+        if os.path.isfile(filename):
+            bin_centers_file, hmf = loadtxt(
+                mass, sim, code, z, f'hmf_{spectrum}', unpack=True,
+            )
+            tables[get_key(bin_centers_file)].append((i, sim, bin_centers_file, hmf))
+            continue
+        # For most codes we have the halo catalogs stored. With the halos
+        # sorted by mass, the cumulative counts at the bin edges are found
+        # by binary search, matching np.histogram() (last bin closed).
+        halomasses, _ = get_halo_catalog(mass, sim, code, z, spectrum)
+        n = count_halos(mass, sim, code, z, spectrum, threshold)
+        halomasses = halomasses[:n][::-1]
+        cumcounts = np.searchsorted(halomasses, bins, side='left')
+        cumcounts[-1] = np.searchsorted(halomasses, bins[-1], side='right')
+        counts[i] = np.diff(cumcounts)
+    # Interpolate tables sharing the same mass grid together
+    if tables:
+        counts = counts.astype(float)
+    for table in tables.values():
+        indices, sims, bin_centers_file, hmf = zip(*table)
+        hmf = np.exp(
+            interp_linear(
+                np.log(bin_centers_file[0]), np.log(hmf), np.log(bin_centers),
+            )
+        )
+        boxsize = np.array([get_boxgrid(sim)[0] for sim in sims])
+        counts[list(indices)] = hmf*boxsize[:, None]**3*np.diff(bins)/bin_centers
     return bin_centers, counts
+def count_halos(mass, sim, code, z, spectrum, threshold):
+    halomasses, _ = get_halo_catalog(mass, sim, code, z, spectrum)
+    if threshold is None:
+        return len(halomasses)
+    if isinstance(threshold, int):
+        # The `threshold` most massive halos
+        return min(threshold, len(halomasses))
+    # Halos with masses above `threshold`
+    return len(halomasses) - int(
+        np.searchsorted(
+            halomasses[::-1], np.float32(float(threshold)), side='right',
+        )
+    )
+HaloCatalog = collections.namedtuple('HaloCatalog', ('masses', 'pos'))
+@functools.lru_cache(maxsize=64)
+def get_halo_catalog(mass, sim, code, z, spectrum):
+    # Halo masses and positions sorted by descending mass, stored as
+    # binary files within the cache and memory mapped read-only.
+    filename = check_header(mass, sim, code, z, f'halo_{spectrum}')
+    info = get_fileinfo(filename)
+    filename_cache = (
+        f'{cache_dir}/halo/{info["key"]}_{info["size"]}_{info["mtime"]}'
+    )
+    filenames = {
+        name: f'{filename_cache}_{name}.npy' for name in HaloCatalog._fields
+    }
+    if not all(map(os.path.isfile, filenames.values())):
+        # Columns: mass, x, y, z. Only the sorted arrays are cached.
+        data = load_cached(filename, dtype=np.float32, cache=False).reshape(-1, 4)
+        order = np.argsort(-data[:, 0], kind='stable')
+        arrays = HaloCatalog(
+            np.ascontiguousarray(data[order, 0]),
+            np.ascontiguousarray(data[order, 1:4]),
+        )
+        for name, array in arrays._asdict().items():
+            with open_atomic(filenames[name]) as f:
+                np.save(f, array)
+        remove_stale_sidecars(f'{cache_dir}/halo', info)
+    arrays = []
+    for name in HaloCatalog._fields:
+        try:
+            arrays.append(np.load(filenames[name], mmap_mode='r'))
+        except ValueError:
+            # Empty arrays cannot be memory mapped
+            arrays.append(np.load(filenames[name]))
+    return HaloCatalog(*arrays)
 def get_bispec_treelevel(mass, z, spectrum, k_vec, k_plot):
     # Transform k_vec[:] to scalars or the k to be plotted
     collapse = lambda k: k_vec[k_plot - 1] if len(set(k)) > 1 else k[0]
@@ -123,7 +244,7 @@ def get_bispec_treelevel(mass, z, spectrum, k_vec, k_plot):
     # Construct tree-level bispectrum from CLASS power spectrum
     sim, code = 'fiducial', 'class'
     k, power, _ = load_powerspec(mass, sim, code, z, spectrum)
-    power /= (2*np.pi)**3  # use a different Fourier convention
+    power = power/(2*np.pi)**3  # use a different Fourier convention
     spline = scipy.interpolate.interp1d(
         np.log(k),
         np.log(power),
@@ -139,31 +260,28 @@ def get_bispec_treelevel(mass, z, spectrum, k_vec, k_plot):
         for perm in itertools.permutations(range(3))
     )
     return bpower
+@cache_result
 def load_bispec(
-    mass, sim, code, z, spectrum, configuration_expr=None, k_desired=None, modes=None, *,
+    mass, sim, code, z, spectrum, configuration=None, k_desired=None, modes=None, *,
     correct_z=True,
 ):
-    # Load the bispectrum with shot noise already subtracted
-    k1, k2, k3, bpower, modes_read = loadtxt(
-        mass, sim, code, z, f'bispec_{spectrum}',
-        usecols=(0, 1, 2, 6, 8), unpack=True,
-    )
+    # Select closed triangles of the given configuration, either from
+    # the indexed bispectrum table (configuration specified as a triplet,
+    # see select_triangles()) or through a function of (k1, k2, k3).
+    filename = get_filename(mass, sim, code, z, f'bispec_{spectrum}')
+    table = get_bispec_table(filename)
+    if configuration is None:
+        rows = np.arange(table.bpower.size)
+    elif callable(configuration):
+        rows = np.flatnonzero(configuration(*table.k.astype(float)))
+    else:
+        rows = select_triangles(table, configuration)
+    k1, k2, k3 = table.k[:, rows].astype(float)
+    bpower = table.bpower[rows]
     if modes is None:
-        modes = modes_read
-    # Keep only closed triangles
-    closed = (k1 < k2 + k3)
-    k1     = k1    [closed]
-    k2     = k2    [closed]
-    k3     = k3    [closed]
-    bpower = bpower[closed]
-    modes  = modes [closed]
-    if configuration_expr is not None:
-        mask = configuration_expr(k1, k2, k3)
-        k1     = k1    [mask]
-        k2     = k2    [mask]
-        k3     = k3    [mask]
-        bpower = bpower[mask]
-        modes  = modes [mask]
+        modes = table.modes[rows]
+    else:
+        modes = np.asarray(modes)[table.closed[rows]]
     # Convert to proper units
     boxsize, _ = get_boxgrid(sim)
     k_fundamental = 2*np.pi/boxsize
@@ -182,19 +300,78 @@ def load_bispec(
         mask = (k_lower*(1 - 1e-4) <= k1) & (k1 <= k_upper*(1 + 1e-4))
         bpower[~mask] = np.nan
     return k1, k2, k3, bpower, modes
+BispecTable = collections.namedtuple(
+    'BispecTable',
+    ('k', 'bpower', 'modes', 'closed', 'kmax', 'keys', 'order'),
+)
+@functools.lru_cache(maxsize=64)
+def get_bispec_table(filename):
+    # Bispectrum (with shot noise already subtracted) of closed triangles,
+    # with the integer (k1, k2, k3) in units of the fundamental frequency
+    # indexed through their sorted combined keys.
+    k1, k2, k3, bpower, modes = load_cached(filename, usecols=(0, 1, 2, 6, 8), unpack=True)
+    closed = np.flatnonzero(k1 < k2 + k3)
+    k = np.round((k1[closed], k2[closed], k3[closed])).astype(np.int32)
+    kmax = int(k.max(initial=0))
+    keys = get_triangle_keys(k, kmax)
+    order = np.argsort(keys, kind='stable')
+    return BispecTable(k, bpower[closed], modes[closed], closed, kmax, keys[order], order)
+def get_triangle_keys(k, kmax):
+    k = np.asarray(k, dtype=np.int64)
+    return (k[0]*(kmax + 1) + k[1])*(kmax + 1) + k[2]
+def select_triangles(table, configuration):
+    # The configuration is a triplet (k1, k2, k3) with each leg either an
+    # integer (fixed leg in units of the fundamental frequency), None
+    # (free leg) or 'k' (free legs tied together, e.g. ('k', 'k', 'k') for
+    # equilateral triangles). All candidate triangles are enumerated and
+    # looked up in the sorted keys, giving the table rows in file order.
+    axes = {}
+    legs = []
+    for i, leg in enumerate(configuration):
+        if leg is None:
+            axes[i] = len(axes)
+        elif leg == 'k':
+            axes.setdefault('k', len(axes))
+    k_free = np.arange(1, table.kmax + 1)
+    grid = np.meshgrid(*[k_free]*len(axes), indexing='ij')
+    for i, leg in enumerate(configuration):
+        if leg is None:
+            legs.append(grid[axes[i]].ravel())
+        elif leg == 'k':
+            legs.append(grid[axes['k']].ravel())
+        else:
+            legs.append(np.full(grid[0].size if grid else 1, int(leg)))
+    legs = np.array(legs)
+    inside = (legs <= table.kmax).all(axis=0)
+    keys = get_triangle_keys(legs[:, inside], table.kmax)
+    lower = np.searchsorted(table.keys, keys, 'left')
+    counts = np.searchsorted(table.keys, keys, 'right') - lower
+    index = np.repeat(lower - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return np.sort(table.order[index])
+@cache_result
 def load_powerspec(
     mass, sim, code, z, spectrum, k_desired=None, modes=None, *,
     correct_z=True, subtract_neutrino_shotnoise=True,
 ):
-    # Read in data
-    if codespecs[code].is_simulation:
+    # Read in data, preferring the binary output of compute_powerspec.py
+    # unless older than the text file
+    basename = f'powerspec_{spectrum}'
+    filename_text = get_filename(mass, sim, code, z, basename)
+    filename_binary = f'{filename_text}.npz'
+    if codespecs[code].is_simulation and os.path.isfile(filename_binary) and not (
+        os.path.isfile(filename_text)
+        and os.path.getmtime(filename_binary) < os.path.getmtime(filename_text)
+    ):
+        basename = f'{basename}.npz'
+        k, power, modes_read = load_binary(mass, sim, code, z, basename)
+    elif codespecs[code].is_simulation:
+        # Spectra in redshift space carry the multipoles P2 and P4 as
+        # additional columns, with the monopole as P
         k, power, modes_read = loadtxt(
-            mass, sim, code, z, f'powerspec_{spectrum}', unpack=True,
+            mass, sim, code, z, basename, usecols=(0, 1, 2), unpack=True,
         )
     else:
-        k, power = loadtxt(
-            mass, sim, code, z, f'powerspec_{spectrum}', unpack=True,
-        )
+        k, power = loadtxt(mass, sim, code, z, basename, unpack=True)
         modes_read = None
     if modes is None:
         modes = modes_read
@@ -204,7 +381,7 @@ def load_powerspec(
         return k[:1], power[:1], (None if modes is None else modes[:1])
     # Correct if not exactly at the specified redshift
     if correct_z and spectrum == 'cdm':
-        power *= get_zcorrection_factor(mass, sim, code, z, f'powerspec_{spectrum}')
+        power *= get_zcorrection_factor(mass, sim, code, z, basename)
     # Subtract shotnoise from neutrinos
     boxsize, gridsize = get_boxgrid(sim)
     if subtract_neutrino_shotnoise and codespecs[code].is_simulation and spectrum == 'ncdm':
@@ -248,18 +425,103 @@ def load_powerspec(
             if k[-1] < k_max:
                 k = np.concatenate((k, [k_max]))
                 power = np.concatenate((power, [power[-1]]))
-            k, power, _ = Pk_library.expected_Pk(
-                k.astype(np.float32), power.astype(np.float32), boxsize, gridsize,
-            )
+            k, power, _ = get_expected_powerspec(k, power, boxsize, gridsize)
         k, power, _ = rebin(k_desired, k, power, modes)
         mask = (k_lower <= k) & (k <= k_upper)
         power[~mask] = np.nan
     return k, power, modes
+def get_expected_powerspec(k, power, boxsize, gridsize, bins=750):
+    # Equivalent to Pk_library.expected_Pk(), averaging the interpolated
+    # input power spectrum over all modes of the grid within each |k| shell.
+    # The power may be a 2D stack of spectra sharing k. The interpolation
+    # mirrors that of Pylians, including its single precision arithmetic,
+    # while the averaging over modes is carried out using a precomputed
+    # sparse operator acting on the distinct values of |k|. Deliberately,
+    # the last interpolation points are taken from the last interval of
+    # the input. Pylians instead reads past the end of the input when the
+    # last of these exceeds the input range by rounding, which corrupts
+    # the top few shells (NaN or off by orders of magnitude).
+    k_in = np.asarray(k, dtype=np.float32)
+    power_in = np.asarray(power, dtype=np.float32)
+    shells = get_mode_shells(gridsize)
+    k_fundamental = np.float32(2*np.pi/boxsize)
+    if k_fundamental < k_in[0] or shells.kmax*k_fundamental > k_in[-1]:
+        raise ValueError('k value in grid outside input k range')
+    # Resample input power spectrum at logarithmically spaced k
+    log10_kmin = np.log10(np.float64(k_in[0]))
+    deltak = np.float32((np.log10(np.float64(k_in[-1])) - log10_kmin)/(bins - 1.0))
+    k_interp = (
+        10**(log10_kmin + (deltak*np.arange(bins, dtype=np.float32)).astype(np.float64))
+    ).astype(np.float32)
+    j = np.clip(np.searchsorted(k_in, k_interp, 'left'), 1, k_in.size - 1)
+    power_interp = (
+        (power_in[..., j] - power_in[..., j - 1])/(k_in[j] - k_in[j - 1])
+        *(k_interp - k_in[j - 1]) + power_in[..., j - 1]
+    )
+    # Interpolate at the distinct |k| of the grid
+    k_modes = shells.k*k_fundamental
+    i = ((np.log10(k_modes.astype(np.float64)) - log10_kmin)/np.float64(deltak)).astype(int)
+    power_modes = (
+        (power_interp[..., i + 1] - power_interp[..., i])/(k_interp[i + 1] - k_interp[i])
+        *(k_modes - k_interp[i]) + power_interp[..., i]
+    )
+    # Average over modes within shells
+    k = shells.operator @ k_modes.astype(np.float64)
+    power = (shells.operator @ power_modes.reshape(-1, k_modes.size).astype(np.float64).T).T
+    power = power.reshape(power_in.shape[:-1] + (-1, ))
+    return k, power, shells.modes
+ModeShells = collections.namedtuple(
+    'ModeShells', ('k', 'modes', 'operator', 'kmax'),
+)
+@functools.lru_cache
+def get_mode_shells(gridsize):
+    # The independent modes of a grid, grouped by their integer |k|^2
+    # in units of the fundamental frequency, using the conventions of
+    # Pylians. The multiplicities are stored in the cache.
+    middle = gridsize//2
+    kmax = int(np.sqrt(3*middle**2))
+    filename = f'{cache_dir}/modes/modes_{gridsize}.npy'
+    if os.path.isfile(filename):
+        multiplicity = np.load(filename)
+    else:
+        multiplicity = np.zeros(3*middle**2 + 1, dtype=np.int64)
+        ky = np.arange(gridsize)
+        ky[ky > middle] -= gridsize
+        kz = np.arange(middle + 1)
+        ky, kz = np.meshgrid(ky, kz, indexing='ij')
+        special = (kz == 0) | ((kz == middle) & (gridsize%2 == 0))
+        for kx in range(gridsize):
+            kx -= gridsize*(kx > middle)
+            # Skip modes redundant due to Hermitian symmetry
+            keep = np.ones(special.shape, dtype=bool)
+            if kx < 0:
+                keep = ~special
+            elif kx == 0 or (kx == middle and gridsize%2 == 0):
+                keep = ~special | (ky >= 0)
+            multiplicity += np.bincount(
+                (kx**2 + ky**2 + kz**2)[keep], minlength=multiplicity.size,
+            )
+        multiplicity[0] = 0  # DC mode
+        with open_atomic(filename) as f:
+            np.save(f, multiplicity)
+    k2 = np.flatnonzero(multiplicity)
+    k = np.sqrt(k2).astype(np.float32)
+    shell = k.astype(int) - 1
+    modes = np.bincount(shell, weights=multiplicity[k2], minlength=kmax)
+    operator = scipy.sparse.csr_matrix(
+        (multiplicity[k2]/modes[shell], (shell, np.arange(k2.size))),
+        shape=(kmax, k2.size),
+    )
+    return ModeShells(k, modes, operator, kmax)
 def get_filename(mass, sim, code, z, basename, try_fiducial=True):
     sim_name = get_sim_name(mass, sim)
     basename = basename.replace(' ', '')
-    filename = f'{this_dir}/../data/{sim_name}/{code}/z{z}/{basename}'
-    if not os.path.isfile(filename) and not codespecs[code].is_simulation:
+    relpath = f'{sim_name}/{code}/z{z}/{basename}'
+    filename = f'{data_dir}/{relpath}'
+    if (
+        try_fiducial and not codespecs[code].is_simulation
+        and relpath not in get_catalog() and not os.path.isfile(filename)
+    ):
         return get_filename(mass, 'fiducial', code, z, basename, try_fiducial=False)
     return filename
 def get_boxgrid(sim):
@@ -273,16 +535,26 @@ def get_boxgrid(sim):
 def get_sim_name(mass, sim):
     return f'{float(mass)}eV' + f'_{sim}'*(sim != 'fiducial')
 def get_zcorrection_factor(mass, sim, code, z, basename):
-    filename = get_filename(mass, sim, code, z, basename)
-    header = get_header(filename)
-    match = re.search(r' z *= *(.+?) ', '\n'.join(header))
-    fac = 1
-    if match:
-        z_dump = float(match.group(1))
-        if z_dump != z:
-            fac = get_growthfac(mass, z)/get_growthfac(mass, z_dump)
-    spectrum = basename.partition('_')[0]
-    fac **= {'powerspec': 2, 'bispec': 3}.get(spectrum, 1)
+    return get_zcorrection_factors([(mass, sim, code, z, basename)])[0]
+def get_zcorrection_factors(specs):
+    # Takes an iterable of (mass, sim, code, z, basename), with all growth
+    # factors evaluated in a single vectorised call.
+    masses, redshifts, redshifts_dump, exponents = [], [], [], []
+    for mass, sim, code, z, basename in specs:
+        z_dump = get_fileinfo(get_filename(mass, sim, code, z, basename))['z_dump']
+        masses.append(mass)
+        redshifts.append(z)
+        redshifts_dump.append(z if z_dump is None else z_dump)
+        spectrum = basename.partition('_')[0]
+        exponents.append({'powerspec': 2, 'bispec': 3}.get(spectrum, 1))
+    redshifts, redshifts_dump = np.asarray(redshifts), np.asarray(redshifts_dump)
+    fac = np.ones(len(masses))
+    off = (redshifts_dump != redshifts)
+    if off.any():
+        fac[off] = get_growthfac_ratio(
+            np.asarray(masses)[off], redshifts[off], redshifts_dump[off],
+        )
+    fac **= exponents
     return fac
 def get_plot_kwargs(code, pop=None):
     attrs = {'label', 'color', 'linestyle'}
@@ -302,21 +574,70 @@ def any2list(val):
     except TypeError:
         val = [val]
     return list(val)
+def interp_linear(x, y, x_new):
+    # Linear interpolation (and extrapolation) along the last axis of y,
+    # carried out as by scipy.interpolate.interp1d(kind='linear')
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind='mergesort')
+        x, y = x[order], y[..., order]
+    indices = np.clip(np.searchsorted(x, x_new), 1, len(x) - 1)
+    x_lo, x_hi = x[indices - 1], x[indices]
+    y_lo, y_hi = y[..., indices - 1], y[..., indices]
+    slope = (y_hi - y_lo)/(x_hi - x_lo)
+    return slope*(x_new - x_lo) + y_lo
 def rebin(k_desired, k_in, power_in, modes_in):
-    def get_weights(weights):
-        weights = np.asarray(weights).copy()
-        weights[np.isnan(weights)] = 0
-        return weights
-    k, _     = np.histogram(k_in, k_desired, weights=get_weights(    k_in*modes_in))
-    power, _ = np.histogram(k_in, k_desired, weights=get_weights(power_in*modes_in))
-    modes, _ = np.histogram(k_in, k_desired, weights=get_weights(         modes_in))
+    # The power may be a 2D stack of spectra sharing k_in and modes_in,
+    # all of which are then rebinned in a single pass.
+    power_in = np.asarray(power_in)
+    weights = np.concatenate((
+        [k_in*modes_in, modes_in],
+        power_in.reshape(-1, power_in.shape[-1])*modes_in,
+    ))
+    weights[np.isnan(weights)] = 0
+    k, modes, *power = get_rebinner(k_desired, k_in)(weights)
     mask = (modes > 0)
-    k, power, modes = k[mask], power[mask], modes[mask]
+    k, power, modes = k[mask], np.array(power)[:, mask], modes[mask]
     k /= modes
     power /= modes
     power[power == 0] = np.nan
+    power = power.reshape(power_in.shape[:-1] + (-1, ))
     return k, power, modes
-def get_class_background(mass, extra_params=None):
+def get_rebinner(k_desired, k_in):
+    # The binning of k_in into the bins given by the edges k_desired is
+    # computed once and reused for all weights, which are reduced in the
+    # same manner as within np.histogram() (sorting, cumulative sums),
+    # ensuring identical results.
+    key = (get_key(np.asarray(k_desired)), get_key(np.asarray(k_in)))
+    rebinner = rebinners.get(key)
+    if rebinner is not None:
+        return rebinner
+    k_desired = np.asarray(k_desired)
+    k_in = np.asarray(k_in).ravel()
+    blocks = []
+    for i in range(0, k_in.size, rebin_blocksize):
+        sorting_index = np.argsort(k_in[i:i + rebin_blocksize])
+        sa = k_in[i:i + rebin_blocksize][sorting_index]
+        bin_index = np.concatenate((
+            sa.searchsorted(k_desired[:-1], 'left'),
+            sa.searchsorted(k_desired[-1:], 'right'),
+        ))
+        blocks.append((i, sorting_index, bin_index))
+    def rebinner(weights):
+        weights = np.asarray(weights)
+        cum_n = np.zeros((weights.shape[0], k_desired.size), weights.dtype)
+        zero = np.zeros((weights.shape[0], 1), weights.dtype)
+        for i, sorting_index, bin_index in blocks:
+            sw = weights[:, i:i + rebin_blocksize][:, sorting_index]
+            cw = np.concatenate((zero, sw.cumsum(axis=1)), axis=1)
+            cum_n += cw[:, bin_index]
+        return np.diff(cum_n, axis=1)
+    if len(rebinners) == rebinners_maxsize:
+        rebinners.popitem(last=False)
+    rebinners[key] = rebinner
+    return rebinner
+def get_class_params(mass, extra_params=None):
     if extra_params is None:
         extra_params = {}
     params = {
@@ -350,23 +671,78 @@ def get_class_background(mass, extra_params=None):
         }
     )
     params.update(extra_params)
+    return params
+def get_class_background(mass, extra_params=None):
+    return get_class_output(get_class_params(mass, extra_params), 'background')
+def get_class_output(params, output):
+    # CLASS solves are cached on disk, keyed on the parameters
+    # together with the CLASS version.
+    filename = get_class_cachename(params, output)
+    if os.path.isfile(filename):
+        with np.load(filename) as data:
+            return dict(data)
     cosmo = classy.Class()
     cosmo.set(params)
     cosmo.compute()
-    background = cosmo.get_background()
-    return background
-def get_growthfac(mass, z):
+    data = getattr(cosmo, f'get_{output}')()
+    cosmo.struct_cleanup()
+    with open_atomic(filename) as f:
+        np.savez(f, **data)
+    return data
+def get_class_cachename(params, output):
+    key = get_hash({'params': params, 'output': output, 'version': get_class_version()})
+    return f'{cache_dir}/class/{output}_{key}.npz'
+@functools.lru_cache
+def get_class_version():
+    version = getattr(classy, '__version__', None)
+    if version is None:
+        # Older CLASS wrappers do not expose their version,
+        # in which case the compiled module itself is used.
+        stat = os.stat(classy.__file__)
+        version = f'{stat.st_size}-{stat.st_mtime_ns}'
+    return str(version)
+def warm_class_cache(masses=(0, 0.15, 0.3, 0.6)):
+    # Run the CLASS solves not already cached in parallel processes
+    masses = [
+        mass for mass in any2list(masses)
+        if not os.path.isfile(get_class_cachename(get_class_params(mass), 'background'))
+    ]
+    if not masses:
+        return
+    with concurrent.futures.ProcessPoolExecutor(len(masses)) as executor:
+        for mass, _ in zip(masses, executor.map(get_class_background, masses)):
+            print(f'Cached CLASS background for {mass} eV')
+@functools.lru_cache
+def get_growthfac_table(mass):
+    # Spline of log(D) in log(a), built once per mass and process
     background = get_class_background(mass)
-    growthfac = np.exp(
-        scipy.interpolate.interp1d(
-            np.log(1/(1 + background['z'])),
-            np.log(background['gr.fac. D']),
-            kind='cubic',
-            fill_value='extrapolate',
-        )(np.log(1/(1 + z)))
+    return scipy.interpolate.interp1d(
+        np.log(1/(1 + background['z'])),
+        np.log(background['gr.fac. D']),
+        kind='cubic',
+        fill_value='extrapolate',
     )
-    return growthfac
+def get_growthfac(mass, z):
+    # Both mass and z may be arrays, with a single spline
+    # evaluation carried out for each distinct mass.
+    mass, z = np.broadcast_arrays(mass, z)
+    growthfac = np.empty(z.shape, dtype=float)
+    for mass_unique in np.unique(mass):
+        mask = (mass == mass_unique)
+        growthfac[mask] = np.exp(
+            get_growthfac_table(float(mass_unique))(np.log(1/(1 + z[mask])))
+        )
+    return growthfac[()]
+def get_growthfac_ratio(mass, z, z_dump):
+    # D(z)/D(z_dump), with numerator and denominator evaluated together
+    mass, z, z_dump = np.broadcast_arrays(mass, z, z_dump)
+    growthfac = get_growthfac(np.stack((mass, mass)), np.stack((z, z_dump)))
+    return growthfac[0]/growthfac[1]
 def loadtxt(mass, sim, code, z, basename, **kwargs):
+    filename = check_header(mass, sim, code, z, basename)
+    # Load data
+    return load_cached(filename, **kwargs)
+def check_header(mass, sim, code, z, basename):
     filename = get_filename(mass, sim, code, z, basename)
     # Check whether header is consistent
     header = get_header(filename)
@@ -396,9 +772,171 @@ def loadtxt(mass, sim, code, z, basename, **kwargs):
             print(f'Could not parse header of {filename}', file=sys.stderr)
     if len(header) < 2:
         print(f'Incomplete header of {filename}', file=sys.stderr)
-    # Load data
-    return np.loadtxt(filename, **kwargs)
+    return filename
+def load_binary(mass, sim, code, z, basename):
+    # Power spectrum (k, power, modes) stored in binary form
+    # by compute_powerspec.py, with a typed header
+    filename = get_filename(mass, sim, code, z, basename)
+    with np.load(filename) as data:
+        consistent = (
+            data['sim_name'] == get_sim_name(mass, sim)
+            and data['code'] == code
+            and np.isclose(data['z'], z, atol=0.02)
+            and str(data['spectrum']).replace(' ', '')
+                == basename.partition('_')[2].removesuffix('.npz').replace(' ', '')
+        )
+        if not consistent:
+            print(f'Inconsistent header of {filename}', file=sys.stderr)
+        return data['k'], data['power'], data['modes']
+def load_cached(filename, **kwargs):
+    # Parsed data is kept in a binary sidecar file within the cache,
+    # tied to the size and modification time of the text file as well as
+    # to the loading arguments. Sidecars are memory mapped copy-on-write,
+    # so that in-place operations do not propagate back to the cache.
+    # With cache=False the data is parsed without writing a sidecar.
+    unpack = kwargs.pop('unpack', False)
+    rows = kwargs.pop('rows', None)
+    cache = kwargs.pop('cache', True)
+    if backend == 'store':
+        data = load_store(filename, rows=rows, **kwargs)
+        return data.T if unpack else data
+    if 'dtype' in kwargs:
+        kwargs['dtype'] = np.dtype(kwargs['dtype']).str
+    info = get_fileinfo(filename)
+    filename_cache = (
+        f'{cache_dir}/loadtxt/{info["key"]}_{info["size"]}_{info["mtime"]}_'
+        f'{get_hash(kwargs)}.npy'
+    )
+    if not cache:
+        data = np.loadtxt(filename, **kwargs)
+    elif os.path.isfile(filename_cache):
+        try:
+            data = np.load(filename_cache, mmap_mode='c')
+        except ValueError:
+            # Empty arrays cannot be memory mapped
+            data = np.load(filename_cache)
+    else:
+        data = np.loadtxt(filename, **kwargs)
+        with open_atomic(filename_cache) as f:
+            np.save(f, data)
+        remove_stale_sidecars(f'{cache_dir}/loadtxt', info)
+    data = np.asarray(data)
+    if rows is not None:
+        data = data[rows]
+    if unpack:
+        data = data.T
+    return data
+def remove_stale_sidecars(directory, info):
+    # Sidecars of earlier versions of a data file share its key
+    # but not its size and modification time.
+    prefix = f'{directory}/{info["key"]}_'
+    current = f'{prefix}{info["size"]}_{info["mtime"]}_'
+    for filename in glob(f'{prefix}*'):
+        if not filename.startswith(current):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+def load_store(filename, usecols=None, dtype=float, rows=None):
+    # Data sets in the store are laid out column-wise, so that only the
+    # requested columns (and rows) are read and decompressed.
+    relpath = os.path.relpath(os.path.abspath(filename), data_dir)
+    dataset = get_store()[relpath]
+    if usecols is None:
+        usecols = range(dataset.shape[0])
+    if rows is None:
+        rows = slice(None)
+    data = np.array(
+        [dataset[col, rows] for col in any2list(usecols)],
+        dtype=dtype,
+    ).T
+    # Mimic the squeezing of np.loadtxt()
+    return np.squeeze(data)
+@functools.lru_cache
+def get_store():
+    import h5py  # only needed for the store backend
+    return h5py.File(filename_store, 'r')
+def get_fileinfo(filename):
+    # Size, modification time, header and dumped redshift of data file
+    relpath = os.path.relpath(os.path.abspath(filename), data_dir)
+    catalog = get_catalog()
+    info = catalog.get(relpath)
+    if info is None:
+        # File not present at the time of the scan
+        info = catalog[relpath] = read_fileinfo(filename)
+    return info
+@functools.lru_cache
+def get_catalog():
+    if backend == 'store':
+        # The store carries the catalog of the packed data files
+        return json.loads(get_store()['.catalog'][()].tobytes())
+    return scan_data()
+def scan_data():
+    # Index all data files within data/<sim_name>/<code>/z<z>/,
+    # reusing the previous index for files which are unchanged.
+    filename_catalog = f'{cache_dir}/catalog.json'
+    catalog_old = {}
+    with contextlib.suppress(OSError, ValueError):
+        with open(filename_catalog, 'r') as f:
+            catalog_old = json.load(f)
+    catalog = {}
+    def scandirs(path):
+        with contextlib.suppress(OSError):
+            with os.scandir(path) as it:
+                yield from (
+                    entry for entry in it
+                    if entry.is_dir() and not entry.name.startswith('.')
+                )
+    for entry_sim in scandirs(data_dir):
+        for entry_code in scandirs(entry_sim.path):
+            for entry_z in scandirs(entry_code.path):
+                if not re.fullmatch(r'z.+', entry_z.name):
+                    continue
+                with os.scandir(entry_z.path) as it:
+                    for entry in it:
+                        # Hidden files include the temporary files
+                        # of writes in progress.
+                        if entry.name.startswith('.') or not entry.is_file():
+                            continue
+                        relpath = os.path.relpath(entry.path, data_dir)
+                        info = catalog_old.get(relpath)
+                        try:
+                            stat = entry.stat()
+                            if info is None or (info['size'], info['mtime']) != (stat.st_size, stat.st_mtime_ns):
+                                info = read_fileinfo(entry.path, stat)
+                        except (OSError, UnicodeDecodeError):
+                            # File removed during the scan, or not text
+                            print(f'Could not index {entry.path}', file=sys.stderr)
+                            continue
+                        catalog[relpath] = info
+    if catalog != catalog_old:
+        with open_atomic(filename_catalog, 'w') as f:
+            json.dump(catalog, f, separators=(',', ':'))
+    return catalog
+def read_fileinfo(filename, stat=None):
+    if stat is None:
+        stat = os.stat(filename)
+    header = []
+    if not filename.endswith(('.npy', '.npz', '.h5')):
+        header = read_header(filename)
+    match = re.search(r' z *= *(.+?) ', '\n'.join(header))
+    z_dump = None
+    if match:
+        with contextlib.suppress(ValueError):
+            z_dump = float(match.group(1))
+    elif filename.endswith('.npz'):
+        # Binary power spectra store the redshift as a field
+        with contextlib.suppress(OSError, KeyError, ValueError):
+            with np.load(filename) as data:
+                z_dump = float(data['z'])
+    return {
+        'key': get_hash(os.path.realpath(filename)),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'header': header,
+        'z_dump': z_dump,
+    }
 def get_header(filename):
+    return get_fileinfo(filename)['header']
+def read_header(filename):
     header = []
     with open(filename, 'r') as f:
         for line in f:
@@ -406,4 +944,38 @@ def get_header(filename):
                 break
             header.append(line.strip(' #\r\n\t'))
     return header
+def get_key(obj):
+    # Hashable key of object, with arrays keyed by their content
+    if isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        return ('ndarray', obj.dtype.str, obj.shape, hashlib.sha1(obj.tobytes()).hexdigest())
+    if isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, tuple(get_key(el) for el in obj))
+    return obj
+def get_hash(obj):
+    # Hash of JSON-serialisable object, independent of dict ordering
+    return hashlib.sha1(
+        json.dumps(obj, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+@contextlib.contextmanager
+def open_atomic(filename, mode='wb'):
+    # Writes go to a temporary file which replaces the target only
+    # upon success, so that concurrent readers never see partial files.
+    dirname = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(dirname, exist_ok=True)
+    fd, filename_tmp = tempfile.mkstemp(dir=dirname, prefix=f'.{os.path.basename(filename)}.')
+    umask = os.umask(0)
+    os.umask(umask)
+    os.fchmod(fd, 0o666 & ~umask)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(filename_tmp, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filename_tmp)
+        raise
 
+if __name__ == '__main__':
+    scan_data()
+    warm_class_cache()
@@ -0,0 +1,58 @@
+from helper import *
+import h5py
+
+# Specifications
+prefixes = ['powerspec_', 'bispec_', 'halo_', 'hmf_']  # kinds of data files to pack
+compression = 'gzip'                                    # HDF5 compression filter
+chunksize = 2**16                                       # number of rows per chunk
+
+# Main function
+def pack(prefixes, filename_store, compression, chunksize):
+    # Data files matching the prefixes are packed into a single HDF5
+    # store, one data set per file named by its relative path. Data sets
+    # are stored column-wise (one column per chunk), with the headers as
+    # attributes and the catalog of packed files as the '.catalog' data set.
+    catalog = scan_data()
+    with h5py.File(filename_store, 'a') as store:
+        catalog_store = {}
+        if '.catalog' in store:
+            catalog_store = json.loads(store['.catalog'][()].tobytes())
+        for relpath, info in sorted(catalog.items()):
+            if not os.path.basename(relpath).startswith(tuple(prefixes)):
+                continue
+            if relpath.endswith('.npz'):
+                # Binary power spectra are read directly
+                continue
+            if catalog_store.get(relpath) == info and relpath in store:
+                continue
+            data = np.loadtxt(f'{data_dir}/{relpath}', ndmin=2).T
+            if relpath in store:
+                del store[relpath]
+            kwargs = {}
+            if data.size > 0:
+                kwargs = {
+                    'chunks': (1, min(data.shape[1], chunksize)),
+                    'compression': compression,
+                    'shuffle': True,
+                }
+            dataset = store.create_dataset(relpath, data=data, **kwargs)
+            dataset.attrs['header'] = info['header']
+            catalog_store[relpath] = info
+            print(f'Packed {relpath}')
+        # Drop data sets of files which no longer exist
+        for relpath in set(catalog_store) - set(catalog):
+            if relpath in store:
+                del store[relpath]
+            catalog_store.pop(relpath)
+        if '.catalog' in store:
+            del store['.catalog']
+        store.create_dataset(
+            '.catalog',
+            data=np.frombuffer(
+                json.dumps(catalog_store, separators=(',', ':')).encode(),
+                dtype=np.uint8,
+            ),
+        )
+
+if __name__ == '__main__':
+    pack(prefixes, filename_store, compression, chunksize)
@@ -0,0 +1,241 @@
+import itertools, math, os, tempfile
+import numpy as np
+import scipy.fft
+from fourier import get_correction, get_phase, mas_orders
+
+# Out-of-core grids for grids larger than the available memory.
+# A grid is stored in an anonymous file within a scratch directory and
+# accessed through memory maps of blocks of slabs (along the first axis),
+# each of which is unmapped again once used, or through copies of blocks
+# of columns. Particles are deposited onto the grid block by block and
+# the real-to-complex transform is carried out in two passes through the
+# file, first over blocks of slabs and then over blocks of pencils along
+# the first axis. The resulting Fourier space grid can be passed to
+# fourier.get_power() in place of an array.
+
+# Grid stored on disk
+class Grid:
+    def __init__(self, shape, dtype, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.directory = directory
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.file.truncate(self.dtype.itemsize*math.prod(self.shape))
+    def __len__(self):
+        return self.shape[0]
+    def __getitem__(self, i):
+        # Single slab
+        if not 0 <= i < self.shape[0]:
+            raise IndexError(f'Slab {i} out of range for grid of shape {self.shape}')
+        return self.map(i, i + 1)[0]
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+    def map(self, start=0, stop=None):
+        # Memory map of the slabs start:stop
+        stop = (self.shape[0] if stop is None else stop)
+        itemsize_slab = self.dtype.itemsize*math.prod(self.shape[1:])
+        return np.memmap(
+            self.file, dtype=self.dtype, mode='r+', offset=start*itemsize_slab,
+            shape=(stop - start, ) + self.shape[1:],
+        )
+    def read_columns(self, start, stop):
+        # Copy of the columns start:stop (along the second axis) of all
+        # slabs, read without memory mapping the entire file
+        itemsize_column = self.dtype.itemsize*math.prod(self.shape[2:])
+        itemsize_slab = itemsize_column*self.shape[1]
+        columns = np.empty((self.shape[0], stop - start) + self.shape[2:], dtype=self.dtype)
+        for i, column in enumerate(columns):
+            column[...] = np.frombuffer(
+                os.pread(
+                    self.file.fileno(), column.nbytes,
+                    i*itemsize_slab + start*itemsize_column,
+                ),
+                dtype=self.dtype,
+            ).reshape(column.shape)
+        return columns
+    def write_columns(self, start, columns):
+        # Write back columns as obtained from read_columns()
+        itemsize_column = self.dtype.itemsize*math.prod(self.shape[2:])
+        itemsize_slab = itemsize_column*self.shape[1]
+        for i, column in enumerate(np.require(columns, self.dtype, 'C')):
+            os.pwrite(
+                self.file.fileno(), column.tobytes(),
+                i*itemsize_slab + start*itemsize_column,
+            )
+    def blocks(self, rows):
+        # Memory maps of consecutive blocks of (at most) rows slabs
+        for start in range(0, self.shape[0], rows):
+            yield self.map(start, min(start + rows, self.shape[0]))
+def get_rows(gridsize, memory):
+    # Number of slabs per block for the given memory in GB. The
+    # deposition needs about four double precision slabs per slab
+    # (the block itself, its increment and the indices and weights of
+    # the particles), which also covers the transforms.
+    return max(1, min(gridsize, int(memory*2**30/(32*gridsize**2))))
+
+# Mass assignment
+class Deposition:
+    # Deposition of particles onto a new grid. Chunks of particles are
+    # added by sorting them into buckets, one for each block of slabs
+    # and stored on disk, after which finish() deposits the blocks one
+    # at a time and returns the grid.
+    def __init__(self, gridsize, boxsize, mas, rows, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.gridsize = gridsize
+        self.mas = mas
+        self.rows = rows
+        self.directory = directory
+        self.inv_cellsize = np.float32(gridsize)/np.float32(boxsize)
+        self.nblocks = -(-gridsize//rows)
+        self.buckets = [tempfile.TemporaryFile(dir=directory) for _ in range(self.nblocks)]
+        self.ncols = 3
+    def add(self, pos, weights=None):
+        if weights is not None:
+            self.ncols = 4
+            records = np.empty((len(pos), self.ncols), dtype=np.float32)
+            records[:, :3] = pos
+            records[:, 3] = weights
+        else:
+            records = np.asarray(pos, dtype=np.float32)
+        block = get_first_cell(
+            records[:, 0]*self.inv_cellsize, mas_orders[self.mas],
+        )%self.gridsize//self.rows
+        bounds = np.concatenate(
+            ([0], np.cumsum(np.bincount(block, minlength=self.nblocks)))
+        )
+        records = records[np.argsort(block, kind='stable')]
+        for bucket, start, stop in zip(self.buckets, bounds[:-1], bounds[1:]):
+            records[start:stop].tofile(bucket)
+    def finish(self):
+        # Deposit each block in double precision, with order - 1
+        # additional slabs receiving the particles spilling over into
+        # the next block(s)
+        gridsize, rows, ncols = self.gridsize, self.rows, self.ncols
+        order = mas_orders[self.mas]
+        grid = Grid([gridsize]*3, np.float32, self.directory)
+        for i, bucket in enumerate(self.buckets):
+            start = i*rows
+            stop = min(start + rows, gridsize)
+            number = np.zeros((stop - start + order - 1, gridsize, gridsize))
+            count = max(1, number.size//order**3)
+            bucket.seek(0)
+            while True:
+                records = np.fromfile(bucket, dtype=np.float32, count=count*ncols)
+                if records.size == 0:
+                    break
+                records = records.reshape(-1, ncols)
+                deposit_block(
+                    records[:, :3], (records[:, 3] if ncols == 4 else None),
+                    number, self.inv_cellsize, start, self.mas,
+                )
+            bucket.close()
+            for j, slab in enumerate(number, start):
+                view = grid[j%gridsize]
+                view += slab
+                del view
+            del number
+        self.buckets = []
+        return grid
+def deposit_block(pos, weights, number, inv_cellsize, offset, mas):
+    # Deposition onto the block number of slabs starting at slab offset,
+    # with the single precision weights computed as in MAS_library
+    gridsize = number.shape[1]
+    order = mas_orders[mas]
+    dist = pos*inv_cellsize
+    first = get_first_cell(dist, order)
+    if mas == 'NGP':
+        kernel = np.ones(dist.shape + (1, ), dtype=np.float32)
+    elif mas == 'CIC':
+        u = dist - np.trunc(dist)
+        kernel = np.stack((np.float32(1) - u, u), axis=2)
+    else:
+        cells = (first[:, :, None] + np.arange(order)).astype(np.float32)
+        diff = np.abs(cells - dist[:, :, None])
+        d = diff.astype(np.float64)
+        if mas == 'TSC':
+            kernel = np.where(
+                d < 0.5, 0.75 - diff*diff,
+                np.where(d < 1.5, 0.5*(1.5 - d)*(1.5 - d), 0),
+            )
+        else:
+            kernel = np.where(
+                d < 1, (4 - 6*d*d + 3*d*d*d)/6,
+                np.where(d < 2, (2 - d)*(2 - d)*(2 - d)/6, 0),
+            )
+        kernel = kernel.astype(np.float32)
+    # Cells along x relative to the block, and periodic along y and z
+    cells = first[:, :, None] + np.arange(order)
+    cells[:, 0] = (first[:, :1]%gridsize - offset) + np.arange(order)
+    cells[:, 1:] %= gridsize
+    index = []
+    values = []
+    for l, m, n in itertools.product(range(order), repeat=3):
+        index.append((cells[:, 0, l]*gridsize + cells[:, 1, m])*gridsize + cells[:, 2, n])
+        value = kernel[:, 0, l]*kernel[:, 1, m]*kernel[:, 2, n]
+        if weights is not None:
+            value *= weights
+        values.append(value)
+    number += np.bincount(
+        np.concatenate(index), weights=np.concatenate(values),
+        minlength=number.size,
+    ).reshape(number.shape)
+def get_first_cell(dist, order):
+    # Lowest cell receiving mass from a particle at the given distance
+    # (in units of the cell size) along an axis
+    if order == 2:
+        return dist.astype(np.intp)
+    return np.floor(dist - np.float32(order/2)).astype(np.intp) + 1
+
+# Fourier transform
+def fft_field(delta, mas, rows, threads=1, delta_shifted=None):
+    # Out-of-core counterpart of fourier.fft_field(), transforming delta
+    # (and delta_shifted) onto a new grid in two passes, the second of
+    # which also interlaces and deconvolves the mass assignment as in
+    # fourier.interlace() and fourier.deconvolve().
+    gridsize = delta.shape[0]
+    deltas_k = []
+    for grid in (delta, delta_shifted):
+        if grid is None:
+            continue
+        delta_k = Grid(
+            (gridsize, gridsize, gridsize//2 + 1), np.complex64, grid.directory,
+        )
+        # Two-dimensional transforms of blocks of slabs
+        for start in range(0, gridsize, rows):
+            stop = min(start + rows, gridsize)
+            view = delta_k.map(start, stop)
+            view[...] = scipy.fft.rfft2(grid.map(start, stop), workers=threads)
+            del view
+        deltas_k.append(delta_k)
+    # One-dimensional transforms of blocks of pencils
+    delta_k = deltas_k[0]
+    correction = get_correction(gridsize, mas)
+    correction_z = correction[:delta_k.shape[2]]
+    phase = get_phase(gridsize)
+    phase_z = phase[:delta_k.shape[2]]
+    for start in range(0, gridsize, rows):
+        stop = min(start + rows, gridsize)
+        pencils, *pencils_shifted = [
+            scipy.fft.fft(
+                delta_k.read_columns(start, stop), axis=0, workers=threads,
+                overwrite_x=True,
+            )
+            for delta_k in deltas_k
+        ]
+        if pencils_shifted:
+            pencils_shifted = pencils_shifted[0]
+            pencils_shifted *= (
+                (phase[:, None, None]*phase[None, start:stop, None])
+                *phase_z[None, None, :]
+            ).astype(np.complex64)
+            pencils += pencils_shifted
+            pencils *= 0.5
+        pencils *= (
+            (correction[:, None, None]*correction[None, start:stop, None])
+            *correction_z[None, None, :]
+        ).astype(np.float32)
+        delta_k.write_columns(start, pencils)
+        del pencils, pencils_shifted
+    return delta_k
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('classy')
+pytest.importorskip('Pk_library')
+import helper
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+    monkeypatch.setattr(helper, 'data_dir', str(tmp_path))
+    monkeypatch.setattr(helper, 'cache_dir', str(tmp_path/'.cache'))
+    helper.get_catalog.cache_clear()
+    # Bispectrum file of random triangles (some of them open, some
+    # repeated) in units of the fundamental frequency
+    rng = np.random.default_rng(0)
+    k = rng.integers(1, 13, (3, 2000))
+    k = np.concatenate((k, k[:, :100]), axis=1)
+    data = np.concatenate((k, rng.random((6, k.shape[1]))))
+    filename = tmp_path/'bispec_cdm'
+    np.savetxt(filename, data.T)
+    yield helper.get_bispec_table(str(filename))
+    helper.get_catalog.cache_clear()
+
+@pytest.mark.parametrize('configuration, expr', [
+    (('k', 'k', 'k'), lambda k1, k2, k3: (k1 == k2) & (k2 == k3)),
+    (('k', 'k', 4), lambda k1, k2, k3: (k1 == k2) & (k3 == 4)),
+    ((9, 5, None), lambda k1, k2, k3: (k1 == 9) & (k2 == 5)),
+    ((7, None, 3), lambda k1, k2, k3: (k1 == 7) & (k3 == 3)),
+    ((None, 'k', 'k'), lambda k1, k2, k3: k2 == k3),
+    ((None, None, None), lambda k1, k2, k3: np.ones_like(k1, dtype=bool)),
+    ((6, 6, 6), lambda k1, k2, k3: (k1 == 6) & (k2 == 6) & (k3 == 6)),
+    ((20, None, None), lambda k1, k2, k3: k1 == 20),
+])
+def test_select_triangles_matches_mask(table, configuration, expr):
+    # The rows of the indexed lookup are those of masking the table
+    rows = helper.select_triangles(table, configuration)
+    assert np.array_equal(rows, np.flatnonzero(expr(*table.k)))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('classy')
+pytest.importorskip('Pk_library')
+import helper
+
+@pytest.mark.parametrize('gridsize', [16, 17, 32])
+def test_expected_powerspec_brute_force(tmp_path, monkeypatch, gridsize):
+    monkeypatch.setattr(helper, 'cache_dir', str(tmp_path))
+    helper.get_mode_shells.cache_clear()
+    boxsize = 100
+    k_fundamental = 2*np.pi/boxsize
+    k_top = np.sqrt(3)*(gridsize//2)*k_fundamental
+    # Input range just covering the grid, as in load_powerspec()
+    k = np.logspace(np.log10(k_fundamental*(1 - 1e-3)), np.log10(k_top*(1 + 1e-3)), 200)
+    power = 1e4*(k/0.2)/(1 + (k/0.2)**2.5)
+    k_shells, power_shells, modes = helper.get_expected_powerspec(k, power, boxsize, gridsize)
+    # Brute force over all modes of the grid, keeping the independent
+    # ones as Pylians
+    middle = gridsize//2
+    freq = np.arange(gridsize)
+    freq[freq > middle] -= gridsize
+    kx, ky, kz = np.meshgrid(freq, freq, np.arange(middle + 1), indexing='ij')
+    special = (kz == 0) | ((kz == middle) & (gridsize%2 == 0))
+    boundary = (kx == 0) | ((kx == middle) & (gridsize%2 == 0))
+    keep = ~(special & ((kx < 0) | (boundary & (ky < 0))))
+    keep &= (kx**2 + ky**2 + kz**2 > 0)
+    k_modes = np.sqrt(kx**2 + ky**2 + kz**2)[keep]
+    shell = k_modes.astype(np.float32).astype(int) - 1
+    modes_expected = np.bincount(shell)
+    power_expected = np.bincount(
+        shell, weights=np.interp(k_modes*k_fundamental, k, power),
+    )/modes_expected
+    assert np.array_equal(modes, modes_expected)
+    assert np.all(np.isfinite(power_shells))
+    assert np.allclose(power_shells, power_expected, rtol=1e-3)
+    assert np.allclose(
+        k_shells, np.bincount(shell, weights=k_modes)/modes_expected*k_fundamental, rtol=1e-6,
+    )
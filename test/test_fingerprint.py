@@ -0,0 +1,62 @@
+import json, os
+import numpy as np
+import pytest
+
+pytest.importorskip('classy')
+pytest.importorskip('Pk_library')
+import compute_powerspec
+
+@pytest.fixture
+def inputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(compute_powerspec, 'get_boxgrid', lambda sim: (512, 64))
+    monkeypatch.setattr(compute_powerspec, 'mas', 'CIC')
+    filenames_snapshot = [str(tmp_path/f'snapshot.{i}') for i in range(2)]
+    filenames_halo = [str(tmp_path/'halo_cdm')]
+    for filename in filenames_snapshot + filenames_halo:
+        with open(filename, 'wb') as f:
+            f.write(b'\0'*64)
+        os.utime(filename, ns=(10**18, 10**18))
+    return filenames_snapshot, filenames_halo
+
+def test_fingerprint_roundtrip(tmp_path, inputs):
+    # The fingerprint is recovered from the header of an output
+    fingerprint = compute_powerspec.get_fingerprint('fiducial', *inputs)
+    filename = tmp_path/'powerspec_cdm'
+    np.savetxt(filename, np.ones((2, 3)), header='\n'.join([
+        'Auto power spectrum for 0.0eV gadget3 z=0 cdm (CIC)',
+        f'Fingerprint: {json.dumps(fingerprint, separators=(",", ":"))}',
+        'k [h/Mpc] P [(Mpc/h)^3] modes',
+    ]))
+    fingerprint_output = compute_powerspec.read_fingerprint(str(filename))
+    assert fingerprint_output == fingerprint
+    assert compute_powerspec.get_changes(fingerprint_output, fingerprint) == []
+
+def test_fingerprint_changes(inputs, monkeypatch):
+    filenames_snapshot, filenames_halo = inputs
+    get_fingerprint = lambda: compute_powerspec.get_fingerprint(
+        'fiducial', filenames_snapshot, filenames_halo,
+    )
+    fingerprint = get_fingerprint()
+    assert compute_powerspec.get_changes(fingerprint, get_fingerprint()) == []
+    # Rewritten snapshot file and halo catalog
+    os.utime(filenames_snapshot[1], ns=(2*10**18, 2*10**18))
+    assert compute_powerspec.get_changes(fingerprint, get_fingerprint()) == ['snapshot changed']
+    with open(filenames_halo[0], 'ab') as f:
+        f.write(b'\0')
+    os.utime(filenames_halo[0], ns=(10**18, 10**18))
+    assert compute_powerspec.get_changes(fingerprint, get_fingerprint()) == [
+        'snapshot changed', 'halos changed',
+    ]
+    # Settings and version of the computation
+    fingerprint = get_fingerprint()
+    monkeypatch.setattr(compute_powerspec, 'mas', 'TSC')
+    monkeypatch.setattr(compute_powerspec, 'version', compute_powerspec.version + 1)
+    assert compute_powerspec.get_changes(fingerprint, get_fingerprint()) == [
+        'mas changed from CIC to TSC',
+        f'version changed from {compute_powerspec.version - 1} to {compute_powerspec.version}',
+    ]
+    # Outputs of earlier runs lacking part of the fingerprint
+    del fingerprint['version']
+    assert compute_powerspec.get_changes(fingerprint, get_fingerprint())[-1] == (
+        f'version changed from None to {compute_powerspec.version}'
+    )
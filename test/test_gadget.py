@@ -0,0 +1,67 @@
+import struct
+import numpy as np
+import pytest
+
+readgadget = pytest.importorskip('readgadget')
+import gadget
+
+def write_snapshot(directory, fmt, nfiles, z, masses):
+    # Small multi-file GADGET snapshot of cdm (type 1) and ncdm (type 2)
+    # particles, with the ncdm masses stored in a block unless fixed
+    rng = np.random.default_rng(0)
+    boxsize = 512e+3
+    nall = np.array([0, 300, 200, 0, 0, 0])
+    massarr = np.array([0, 80, (0.8 if masses == 'fixed' else 0), 0, 0, 0], dtype=float)
+    def write_block(f, name, data):
+        data = np.ascontiguousarray(data).tobytes()
+        if fmt == 2:
+            f.write(struct.pack('<i4sii', 8, name.encode(), len(data) + 8, 8))
+        f.write(struct.pack('<i', len(data)) + data + struct.pack('<i', len(data)))
+    pos = {ptype: (rng.random((n, 3))*boxsize).astype(np.float32) for ptype, n in [(1, 300), (2, 200)]}
+    vel = {ptype: rng.normal(0, 300, (n, 3)).astype(np.float32) for ptype, n in [(1, 300), (2, 200)]}
+    ids = {1: np.arange(300, dtype=np.uint32), 2: 300 + np.arange(200, dtype=np.uint32)}
+    mass = rng.uniform(0.7, 0.9, 200).astype(np.float32)
+    for i in range(nfiles):
+        selections = {
+            ptype: slice(nall[ptype]*i//nfiles, nall[ptype]*(i + 1)//nfiles)
+            for ptype in (1, 2)
+        }
+        npart = np.zeros(6, dtype=np.int32)
+        for ptype, selection in selections.items():
+            npart[ptype] = selection.stop - selection.start
+        head = struct.pack(
+            '<6i6d2d2i6I2i4d2i6I', *npart, *massarr, 1/(1 + z), z, 0, 0, *nall, 0,
+            nfiles, boxsize, 0.3, 0.7, 0.67, 0, 0, *[0]*6,
+        )
+        filename = directory/(f'snapshot.{i}' if nfiles > 1 else 'snapshot')
+        with open(filename, 'wb') as f:
+            write_block(f, 'HEAD', head.ljust(256, b'\0'))
+            for name, data in [('POS ', pos), ('VEL ', vel), ('ID  ', ids)]:
+                write_block(f, name, np.concatenate([data[ptype][selections[ptype]] for ptype in (1, 2)]))
+            if masses == 'block':
+                write_block(f, 'MASS', mass[selections[2]])
+    return str(directory/'snapshot')
+
+@pytest.mark.parametrize('fmt, nfiles, z, masses', [
+    (1, 1, 0, 'fixed'),
+    (1, 3, 1, 'fixed'),
+    (2, 2, 1, 'fixed'),
+    (2, 2, 0, 'block'),
+])
+def test_gadget_matches_readgadget(tmp_path, fmt, nfiles, z, masses):
+    snapshot = write_snapshot(tmp_path, fmt, nfiles, z, masses)
+    header_expected = readgadget.header(snapshot)
+    header = gadget.header(snapshot)
+    for name in header._fields:
+        assert np.array_equal(getattr(header, name), getattr(header_expected, name)), name
+    blocks = [('POS ', [1]), ('POS ', [2]), ('POS ', [1, 2]), ('VEL ', [1, 2]), ('ID  ', [2, 1])]
+    if masses == 'block':
+        blocks.append(('MASS', [2]))
+    for block, ptypes in blocks:
+        data_expected = readgadget.read_block(snapshot, block, ptypes)
+        data = gadget.read_block(snapshot, block, ptypes)
+        assert data.dtype == data_expected.dtype
+        assert np.array_equal(data, data_expected), (block, ptypes)
+    # Chunks cover the block of each file in order
+    chunks = list(gadget.open_snapshot(snapshot).iterate('POS ', 1, 64))
+    assert np.array_equal(np.concatenate(chunks), readgadget.read_block(snapshot, 'POS ', [1]))
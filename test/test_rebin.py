@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('classy')
+pytest.importorskip('Pk_library')
+import helper
+
+def rebin_histogram(k_desired, k_in, power_in, modes_in):
+    # Previous implementation, with one np.histogram() per weight
+    def get_weights(weights):
+        weights = np.asarray(weights).copy()
+        weights[np.isnan(weights)] = 0
+        return weights
+    k, _     = np.histogram(k_in, k_desired, weights=get_weights(    k_in*modes_in))
+    power, _ = np.histogram(k_in, k_desired, weights=get_weights(power_in*modes_in))
+    modes, _ = np.histogram(k_in, k_desired, weights=get_weights(         modes_in))
+    mask = (modes > 0)
+    k, power, modes = k[mask], power[mask], modes[mask]
+    k /= modes
+    power /= modes
+    power[power == 0] = np.nan
+    return k, power, modes
+
+@pytest.mark.parametrize('size', [1000, 3*helper.rebin_blocksize + 17])
+def test_rebin_matches_histogram(size):
+    rng = np.random.default_rng(0)
+    k_in = rng.uniform(0.005, 2, size)
+    modes_in = rng.integers(1, 100, size).astype(float)
+    power_in = 1e4*rng.random((3, size))
+    power_in[0, ::7] = np.nan
+    power_in[1, :size//3] = 0
+    # Bins beyond the data are empty and dropped
+    k_desired = np.logspace(np.log10(1e-3), np.log10(5), 60)
+    k, power, modes = helper.rebin(k_desired, k_in, power_in, modes_in)
+    for i in range(power_in.shape[0]):
+        k_expected, power_expected, modes_expected = rebin_histogram(
+            k_desired, k_in, power_in[i], modes_in,
+        )
+        assert np.array_equal(k, k_expected)
+        assert np.array_equal(power[i], power_expected, equal_nan=True)
+        assert np.array_equal(modes, modes_expected)
+    # A single spectrum, rebinned through the cached binning
+    assert np.array_equal(
+        helper.rebin(k_desired, k_in, power_in[2], modes_in)[1], power[2],
+    )
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import fourier, slabs
+
+@pytest.mark.parametrize('mas', ['NGP', 'CIC', 'TSC', 'PCS'])
+def test_deposition_new_scratch_dir(tmp_path, mas):
+    # The scratch directory does not exist prior to the deposition
+    directory = tmp_path/'scratch'/'nested'
+    gridsize, boxsize, rows = 16, 100, 3
+    rng = np.random.default_rng(0)
+    pos = (rng.random((5000, 3))*boxsize).astype(np.float32)
+    deposition = slabs.Deposition(gridsize, boxsize, mas, rows, directory)
+    deposition.add(pos[:2000])
+    deposition.add(pos[2000:])
+    grid = deposition.finish()
+    assert directory.is_dir()
+    # Compare against a single block holding the entire (periodic) grid
+    order = fourier.mas_orders[mas]
+    number = np.zeros((gridsize + order - 1, gridsize, gridsize))
+    slabs.deposit_block(pos, None, number, np.float32(gridsize)/np.float32(boxsize), 0, mas)
+    expected = number[:gridsize].copy()
+    expected[:order - 1] += number[gridsize:]
+    delta = grid.map()
+    assert np.isclose(np.sum(delta, dtype=np.float64), len(pos))
+    assert np.allclose(delta, expected, rtol=1e-5, atol=1e-5)
+    # Out-of-core transform agrees with the in-memory one
+    delta_k = slabs.fft_field(grid, mas, rows)
+    expected_k = fourier.fft_field(np.array(delta), mas)
+    assert np.allclose(delta_k.map(), expected_k, rtol=1e-4, atol=1e-2)